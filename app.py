@@ -1,14 +1,22 @@
 import tkinter as tk
 from tkinter import messagebox
 import threading
+import queue
+import time
 import os
 
 from ui import UISetup
-from processor import ImageProcessor
+from cache import default_cache_dir
+from engine import BatchEngine
+from estimate import SavingsEstimator
+from journal import JobJournal, has_unfinished_run
 from utils import FileOperations
 
 
 class ImageSizeReducer:
+    PROGRESS_INTERVAL_MS = 100
+    ESTIMATE_DELAY_MS = 300
+    
     def __init__(self, root):
         self.root = root
         self.root.title("Image Size Reducer")
@@ -20,9 +28,19 @@ class ImageSizeReducer:
         self.quality_var = tk.IntVar(value=85)
         self.compression_var = tk.BooleanVar(value=False)
         
+        self.engine = None
+        self.events = queue.Queue()
+        self.discovered_count = 0
+        
+        self.estimator = None
+        self.estimates = queue.Queue()
+        self._estimate_after = None
+        self._estimate_cancel = None
+        
         self.ui = UISetup(root, self)
-        self.processor = ImageProcessor()
         self.file_ops = FileOperations()
+        self.input_folder.trace_add('write', self.schedule_estimate)
+        self.output_folder.trace_add('write', self.schedule_estimate)
     
     def browse_input_folder(self):
         folder = self.file_ops.select_folder("Select Input Folder")
@@ -44,13 +62,90 @@ class ImageSizeReducer:
     
     def update_quality_label(self, value):
         self.ui.quality_label.config(text=f"{int(float(value))}%")
+        self.schedule_estimate()
     
-    def start_processing(self):
-        thread = threading.Thread(target=self.process_images)
+    def schedule_estimate(self, *args):
+        # The slider reports every step it passes; only the value it rests on is estimated.
+        if self._estimate_after is not None:
+            self.root.after_cancel(self._estimate_after)
+        self._estimate_after = self.root.after(self.ESTIMATE_DELAY_MS, self._start_estimate)
+    
+    def _start_estimate(self):
+        self._estimate_after = None
+        polling = self._estimate_cancel is not None
+        self._cancel_estimate()
+        
+        folder = self.input_folder.get()
+        if self.engine is not None or not folder or not os.path.isdir(folder):
+            self.ui.estimate_label.config(text="")
+            return
+        
+        # Proxies are kept per folder, so moving the slider only re-encodes them.
+        output_folder = self.output_folder.get() or os.path.join(folder, "reduced_images")
+        if (self.estimator is None or self.estimator.input_folder != folder
+                or self.estimator.output_folder != output_folder):
+            self.estimator = SavingsEstimator(folder, output_folder)
+        cancelled = self._estimate_cancel = threading.Event()
+        self.ui.estimate_label.config(text="Estimating savings...")
+        
+        thread = threading.Thread(
+            target=self._run_estimate,
+            args=(self.estimator, self.compression_var.get(), self.quality_var.get(), cancelled)
+        )
         thread.daemon = True
         thread.start()
+        if not polling:
+            self.root.after(self.PROGRESS_INTERVAL_MS, self._drain_estimate)
+    
+    def _cancel_estimate(self):
+        if self._estimate_cancel is not None:
+            self._estimate_cancel.set()
+            self._estimate_cancel = None
     
-    def process_images(self):
+    def _run_estimate(self, estimator, compress, quality, cancelled):
+        # Runs on a worker thread, like process_images; the result goes through a queue.
+        try:
+            estimate = estimator.estimate(compress, quality, cancelled)
+        except Exception as e:
+            print(f"Cannot estimate savings: {e}")
+            estimate = None
+        self.estimates.put((cancelled, estimate))
+    
+    def _drain_estimate(self):
+        while True:
+            try:
+                cancelled, estimate = self.estimates.get_nowait()
+            except queue.Empty:
+                break
+            # Results of estimates that were superseded while running are dropped.
+            if cancelled is self._estimate_cancel:
+                self._estimate_cancel = None
+                self._show_estimate(estimate)
+        
+        if self._estimate_cancel is not None:
+            self.root.after(self.PROGRESS_INTERVAL_MS, self._drain_estimate)
+    
+    def _show_estimate(self, estimate):
+        if estimate is None:
+            self.ui.estimate_label.config(text="")
+            return
+        if not estimate['files']:
+            self.ui.estimate_label.config(text="No images found in the input folder")
+            return
+        
+        self.ui.estimate_label.config(
+            text=f"Estimate: {estimate['original_bytes'] / 1024 / 1024:.1f} MB -> "
+                 f"{estimate['output_bytes'] / 1024 / 1024:.1f} MB "
+                 f"({estimate['saved_percent']:.0f}% smaller), about "
+                 f"{self._format_duration(estimate['seconds'])} for {estimate['files']} files "
+                 f"(from {estimate['sampled']} samples)"
+        )
+    
+    def start_processing(self):
+        if self.engine is not None:
+            return
+        self._cancel_estimate()
+        
         input_folder = self.input_folder.get()
         output_folder = self.output_folder.get()
         
@@ -64,58 +159,157 @@ class ImageSizeReducer:
         
         os.makedirs(output_folder, exist_ok=True)
         
-        image_files = self.file_ops.get_image_files(input_folder)
+        resume = False
+        if has_unfinished_run(output_folder):
+            resume = messagebox.askyesnocancel(
+                "Resume",
+                "The output folder holds an unfinished run.\n"
+                "Resume it, skipping the files it already finished?"
+            )
+            if resume is None:
+                return
         
-        if not image_files:
-            messagebox.showinfo("No Images", "No image files found in the selected folder")
+        engine = BatchEngine(
+            compress=self.compression_var.get(),
+            quality=self.quality_var.get(),
+            cache_dir=default_cache_dir(),
+            dedup='copy'
+        )
+        try:
+            journal = JobJournal(output_folder, input_folder, engine.output_settings(), resume=resume)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
             return
         
-        total_files = len(image_files)
-        success_count = 0
+        self.engine = engine
+        self.discovered_count = 0
+        self.stats = {'processed': 0, 'succeeded': 0, 'bytes_saved': 0, 'last': None,
+                      'resumed': journal.resumed}
+        self.started_at = time.perf_counter()
         
-        self.ui.progress['maximum'] = total_files
         self.ui.progress['value'] = 0
+        self.ui.status_label.config(text="Scanning...")
+        self.ui.start_button.config(state="disabled")
+        self.ui.cancel_button.config(state="normal")
         
-        for idx, image_file in enumerate(image_files):
-            filename = image_file.name
-            output_path = os.path.join(output_folder, filename)
-            
-            self.ui.status_label.config(text=f"Processing: {filename}")
-            
+        thread = threading.Thread(
+            target=self.process_images,
+            args=(engine, journal, os.path.abspath(input_folder), os.path.abspath(output_folder))
+        )
+        thread.daemon = True
+        thread.start()
+        self.root.after(self.PROGRESS_INTERVAL_MS, self._drain_progress)
+    
+    def cancel_processing(self):
+        if self.engine is not None:
+            self.engine.cancel()
+            self.ui.cancel_button.config(state="disabled")
+            self.ui.status_label.config(text="Cancelling...")
+    
+    def process_images(self, engine, journal, input_folder, output_folder):
+        # Runs on the worker thread: it must never touch Tk, only the event queue.
+        try:
+            jobs = self._count_jobs(journal.jobs(self.file_ops.iter_jobs(input_folder, output_folder)))
+            for result in engine.run(jobs):
+                journal.record(result)
+                if result.success:
+                    self._log_result(result)
+                elif result.error:
+                    print(f"Failed to process {result.filename}: {result.error}")
+                self.events.put(('result', result))
+        except Exception as e:
+            self.events.put(('error', str(e)))
+        finally:
+            journal.close()
+        self.events.put(('done', output_folder))
+    
+    def _drain_progress(self):
+        # Everything queued since the last tick is folded into a single redraw, so
+        # the UI cost is per interval rather than per image.
+        finished = None
+        stats = self.stats
+        while True:
             try:
-                if self.compression_var.get():
-                    success = self.processor.compress_with_quality_reduction(
-                        str(image_file), output_path, self.quality_var.get()
-                    )
-                else:
-                    success = self.processor.optimize_without_quality_loss(
-                        str(image_file), output_path
-                    )
-                
-                if success:
-                    success_count += 1
-                    self._log_result(filename, image_file, output_path)
-                    
-            except Exception as e:
-                print(f"Failed to process {filename}: {e}")
-            
-            self.ui.progress['value'] = idx + 1
-            self.root.update_idletasks()
-        
-        self.ui.status_label.config(text="Processing Complete")
+                kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'result':
+                stats['processed'] += 1
+                stats['last'] = payload.filename
+                if payload.success:
+                    stats['succeeded'] += 1
+                    stats['bytes_saved'] += payload.original_size - payload.new_size
+            elif kind == 'error':
+                messagebox.showerror("Error", payload)
+            else:
+                finished = payload
+        
+        self.ui.progress['maximum'] = max(self.discovered_count, 1)
+        self.ui.progress['value'] = stats['processed']
+        
+        if finished is None:
+            if stats['last']:
+                self.ui.status_label.config(text=f"Processed: {stats['last']}\n{self._format_stats()}")
+            self.root.after(self.PROGRESS_INTERVAL_MS, self._drain_progress)
+            return
+        
+        self._finish(finished)
+    
+    def _format_stats(self):
+        stats = self.stats
+        elapsed = time.perf_counter() - self.started_at
+        rate = stats['processed'] / elapsed if elapsed else 0.0
+        text = (f"{stats['processed']}/{self.discovered_count} files  "
+                f"{rate:.1f} files/s  {stats['bytes_saved'] / 1024 / 1024:.1f} MB saved")
+        # The scanner is still streaming, so the ETA only covers files found so far.
+        remaining = self.discovered_count - stats['processed']
+        if rate and remaining > 0:
+            text += f"  ETA {self._format_duration(remaining / rate)}"
+        return text
+    
+    def _format_duration(self, seconds):
+        minutes, seconds = divmod(int(seconds + 0.5), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return f"{hours}:{minutes:02d}:{seconds:02d}"
+        return f"{minutes}:{seconds:02d}"
+    
+    def _finish(self, output_folder):
+        cancelled = self.engine.cancelled.is_set()
+        self.engine = None
+        self.ui.start_button.config(state="normal")
+        self.ui.cancel_button.config(state="disabled")
+        stats = self.stats
+        
+        if not stats['processed'] and not stats['resumed'] and not cancelled:
+            self.ui.status_label.config(text="Ready")
+            messagebox.showinfo("No Images", "No image files found in the selected folder")
+            return
+        
+        title = "Cancelled" if cancelled else "Complete"
+        self.ui.status_label.config(text=f"Processing {title}\n{self._format_stats()}")
         messagebox.showinfo(
-            "Complete",
-            f"Processed {total_files} images\n"
-            f"Successfully reduced: {success_count} images\n"
+            title,
+            f"Processed {stats['processed']} images\n"
+            f"Successfully reduced: {stats['succeeded']} images\n"
+            f"Saved: {stats['bytes_saved'] / 1024 / 1024:.1f} MB\n"
+            + (f"Already finished by the earlier run: {stats['resumed']} images\n" if stats['resumed'] else "") +
             f"Output folder: {output_folder}"
         )
     
-    def _log_result(self, filename, input_path, output_path):
-        original_size = os.path.getsize(str(input_path))
-        new_size = os.path.getsize(output_path)
-        reduction = ((original_size - new_size) / original_size) * 100
+    def _count_jobs(self, jobs):
+        # The scanner streams, so the progress bar grows as files are discovered.
+        self.discovered_count = 0
+        for job in jobs:
+            self.discovered_count += 1
+            yield job
+    
+    def _log_result(self, result):
+        if result.action in ("passthrough", "skipped"):
+            print(f"Unchanged: {result.filename} (already smaller than a re-encode)")
+            return
         
-        print(f"Processed: {filename}")
-        print(f"  Original: {original_size/1024:.1f} KB")
-        print(f"  New: {new_size/1024:.1f} KB")
-        print(f"  Reduction: {reduction:.1f}%")
+        print(f"Processed: {result.filename}")
+        print(f"  Original: {result.original_size/1024:.1f} KB")
+        print(f"  New: {result.new_size/1024:.1f} KB")
+        print(f"  Reduction: {result.reduction:.1f}%")
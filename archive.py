@@ -0,0 +1,172 @@
+import io
+import os
+import tarfile
+import time
+import zipfile
+from collections import deque
+
+from archive_formats import TAR_COMPRESSION, archive_suffix, is_archive
+from pipeline import atomic_write, temp_path_for
+from utils import FileOperations
+
+
+def default_output_for(archive_path):
+    suffix = archive_suffix(archive_path)
+    return f"{archive_path[:-len(suffix)]}_reduced{archive_path[-len(suffix):]}"
+
+
+def safe_member_name(name):
+    # Members are written under the output folder, so names that would climb out
+    # of it (absolute paths, '..') are refused rather than trusted.
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or ':' in parts[0]:
+        return None
+    return '/'.join(parts)
+
+
+def iter_members(archive_path, include=None, exclude=None, file_ops=None):
+    # Yields (name, data, mtime) for each image member, one at a time. Only the
+    # member being handed out is held in memory; TARs are read as a stream.
+    file_ops = file_ops or FileOperations()
+    if archive_suffix(archive_path) == '.zip':
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                name = safe_member_name(info.filename)
+                if info.is_dir() or not name or not file_ops.is_selected_path(name, include, exclude):
+                    continue
+                yield name, archive.read(info), time.mktime(info.date_time + (0, 0, -1))
+    else:
+        with tarfile.open(archive_path, 'r|*') as archive:
+            for member in archive:
+                name = safe_member_name(member.name)
+                if not member.isfile() or not name or not file_ops.is_selected_path(name, include, exclude):
+                    continue
+                yield name, archive.extractfile(member).read(), member.mtime
+
+
+def iter_folder(folder, recursive=True, include=None, exclude=None, file_ops=None):
+    # The same (name, data, mtime) stream for a folder, so it can be packed into an archive.
+    file_ops = file_ops or FileOperations()
+    for path in file_ops.iter_image_files(folder, recursive, include, exclude):
+        with open(path, 'rb') as f:
+            data = f.read()
+        yield os.path.relpath(path, folder).replace(os.sep, '/'), data, os.path.getmtime(path)
+
+
+class FolderOutput:
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self.created_dirs = set()
+    
+    def path_for(self, name):
+        return os.path.join(self.folder, *name.split('/'))
+    
+    def write(self, name, data, mtime):
+        path = self.path_for(name)
+        directory = os.path.dirname(path)
+        if directory not in self.created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.created_dirs.add(directory)
+        atomic_write(path, data)
+    
+    def close(self):
+        pass
+    
+    def abort(self):
+        pass
+
+
+class ArchiveOutput:
+    
+    def __init__(self, path):
+        self.path = path
+        # The archive is built under a temporary name and renamed into place on
+        # close, so an interrupted run never leaves a truncated archive behind.
+        self.tmp_path = temp_path_for(path)
+        suffix = archive_suffix(path)
+        if suffix == '.zip':
+            # Reduced images are already compressed; deflating them again only costs CPU.
+            self.archive = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            self.archive = tarfile.open(self.tmp_path, f"w|{TAR_COMPRESSION[suffix]}")
+    
+    def path_for(self, name):
+        return f"{self.path}/{name}"
+    
+    def write(self, name, data, mtime):
+        if isinstance(self.archive, zipfile.ZipFile):
+            # ZIP timestamps cannot go back before 1980.
+            date_time = time.localtime(max(mtime, 315576000))[:6]
+            self.archive.writestr(zipfile.ZipInfo(name, date_time), data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            self.archive.addfile(info, io.BytesIO(data))
+    
+    def close(self):
+        self.archive.close()
+        os.replace(self.tmp_path, self.path)
+    
+    def abort(self):
+        try:
+            self.archive.close()
+        except Exception:
+            pass
+        if os.path.lexists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def open_output(path):
+    if is_archive(path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        return ArchiveOutput(path)
+    return FolderOutput(path)
+
+
+def process_archive(engine, source_path, output, members):
+    # Members are compressed with engine.process_bytes on a thread pool, since
+    # Pillow releases the GIL while it decodes and encodes. At most two members
+    # per thread are in memory at once, and results are written in source order.
+    from concurrent.futures import ThreadPoolExecutor
+    
+    threads = engine.workers
+    window = deque()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="archive") as executor:
+        for name, data, mtime in members:
+            if engine.cancelled.is_set():
+                break
+            window.append((name, mtime, executor.submit(engine.process_bytes, data, name)))
+            if len(window) >= threads * 2:
+                yield _write_result(engine, source_path, output, *window.popleft())
+        
+        while window:
+            name, mtime, future = window.popleft()
+            if engine.cancelled.is_set():
+                future.cancel()
+                continue
+            yield _write_result(engine, source_path, output, name, mtime, future)
+
+
+def _write_result(engine, source_path, output, name, mtime, future):
+    data, result = future.result()
+    # Auto format can change the extension; the member keeps its folder either way.
+    directory = name.rpartition('/')[0]
+    output_name = os.path.basename(result.output_path)
+    if directory:
+        output_name = f"{directory}/{output_name}"
+    result.input_path = f"{source_path}/{name}"
+    result.output_path = output.path_for(output_name)
+    result.outputs = []
+    
+    if data is not None:
+        try:
+            output.write(output_name, data, mtime)
+        except OSError as e:
+            result.success, result.new_size, result.error = False, 0, str(e)
+    
+    if engine.metrics is not None:
+        engine.metrics.record(result)
+    return result
@@ -0,0 +1,24 @@
+import os
+
+
+# Kept apart from archive.py so the CLI can recognise archive paths without
+# importing tarfile and zipfile on runs that never touch one.
+TAR_COMPRESSION = {
+    '.tar': '',
+    '.tar.gz': 'gz', '.tgz': 'gz',
+    '.tar.bz2': 'bz2', '.tbz2': 'bz2',
+    '.tar.xz': 'xz', '.txz': 'xz',
+}
+ARCHIVE_SUFFIXES = ('.zip',) + tuple(TAR_COMPRESSION)
+
+
+def archive_suffix(path):
+    name = os.path.basename(path).lower()
+    for suffix in sorted(ARCHIVE_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_archive(path):
+    return archive_suffix(path) is not None
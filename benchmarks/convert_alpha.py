@@ -0,0 +1,88 @@
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from processor import ImageProcessor
+
+
+SIZE = (4000, 3000)
+REPEATS = 3
+
+
+def legacy_convert(img):
+    # The pre-rework _convert_to_rgb, kept here as the baseline.
+    if img.mode in ('RGBA', 'LA', 'P'):
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        return background
+    elif img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+
+def make_source(mode):
+    img = Image.effect_mandelbrot(SIZE, (-2, -1.5, 1, 1.5), 64).convert('RGB')
+    alpha = Image.linear_gradient('L').resize(SIZE)
+    if mode == 'RGBA':
+        img.putalpha(alpha)
+        return img
+    if mode == 'LA':
+        img = img.convert('L')
+        img.putalpha(alpha)
+        return img
+    img = img.quantize(128)
+    img.info['transparency'] = bytes(range(0, 256, 2))
+    return img
+
+
+def measure(args):
+    source_path, method, output_format = args
+    # Loading from disk keeps the generator's temporaries out of the high-water mark.
+    img = Image.open(source_path)
+    img.load()
+    processor = ImageProcessor()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        if method == 'legacy':
+            result = legacy_convert(img)
+        else:
+            result = processor._convert_for_output(img, output_format)
+        result.load()
+        del result
+    elapsed = (time.perf_counter() - start) / REPEATS
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    return elapsed, peak / 1024
+
+
+def main():
+    print(f"{'source':<8}{'output':<8}{'method':<10}{'ms':>10}{'extra peak MB':>16}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('RGBA', 'LA', 'P'):
+            source_path = os.path.join(tmp, f"{mode}.png")
+            make_source(mode).save(source_path, compress_level=1)
+            
+            for output_format in ('JPEG', 'PNG'):
+                for method in ('legacy', 'current'):
+                    # A fresh process per case keeps the ru_maxrss high-water marks independent.
+                    with Pool(1) as pool:
+                        elapsed, peak = pool.apply(measure, ((source_path, method, output_format),))
+                    print(f"{mode:<8}{output_format:<8}{method:<10}{elapsed * 1000:>10.1f}{peak:>16.1f}")
+    
+    print("\nNote: the legacy path pasted LA images without their alpha mask, so its LA rows "
+          "skip the compositing the current path performs.")
+
+
+if __name__ == "__main__":
+    main()
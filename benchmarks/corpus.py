@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import tempfile
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+CORPUS_VERSION = 1
+
+# (kind, file format, extension, sizes); every size is generated COUNTS[scale] times.
+CORPUS_SPEC = (
+    ('photo', 'JPEG', '.jpg', ((640, 480), (1920, 1080), (4000, 3000))),
+    ('flat', 'PNG', '.png', ((800, 600), (1920, 1080))),
+    ('alpha', 'PNG', '.png', ((512, 512), (1600, 1200))),
+    ('palette', 'PNG', '.png', ((640, 480), (1600, 1200))),
+    ('large', 'TIFF', '.tiff', ((5000, 3500),)),
+    ('bitmap', 'BMP', '.bmp', ((1024, 768),)),
+    ('web', 'WEBP', '.webp', ((1280, 720), (2560, 1440))),
+)
+
+COUNTS = {'small': 1, 'medium': 4, 'large': 12}
+
+
+def default_corpus_dir(scale):
+    return os.path.join(tempfile.gettempdir(), f"image_size_reducer_corpus_{scale}")
+
+
+def _noise(rng, size, detail):
+    # Random bytes upscaled with a smooth filter give film-grain-like texture
+    # without depending on Pillow's unseeded effect_noise.
+    small = (max(2, size[0] // detail), max(2, size[1] // detail))
+    noise = Image.frombytes('L', small, rng.randbytes(small[0] * small[1]))
+    return noise.resize(size, Image.BICUBIC)
+
+
+def _photo(rng, size):
+    bands = []
+    for _ in range(3):
+        x, y = rng.uniform(-2.0, -0.5), rng.uniform(-1.2, 0.2)
+        span = rng.uniform(0.05, 1.5)
+        band = Image.effect_mandelbrot(size, (x, y, x + span, y + span * size[1] / size[0]), 96)
+        bands.append(Image.blend(band, _noise(rng, size, rng.choice((2, 4, 8))), 0.35))
+    return Image.merge('RGB', bands).filter(ImageFilter.GaussianBlur(1))
+
+
+def _flat(rng, size, mode='RGB', shapes=40):
+    img = Image.new(mode, size, tuple(rng.randrange(256) for _ in mode))
+    draw = ImageDraw.Draw(img)
+    for _ in range(shapes):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        box = (x0, y0, x0 + rng.randrange(20, size[0] // 2), y0 + rng.randrange(20, size[1] // 2))
+        fill = tuple(rng.randrange(256) for _ in mode)
+        if rng.random() < 0.5:
+            draw.rectangle(box, fill=fill)
+        else:
+            draw.ellipse(box, fill=fill)
+    return img
+
+
+def _make_image(kind, rng, size):
+    if kind in ('photo', 'large', 'web'):
+        return _photo(rng, size)
+    if kind == 'alpha':
+        return _flat(rng, size, 'RGBA')
+    if kind == 'palette':
+        img = _flat(rng, size).quantize(rng.choice((16, 64, 256)))
+        img.info['transparency'] = 0
+        return img
+    if kind == 'bitmap':
+        return _flat(rng, size) if rng.random() < 0.5 else _photo(rng, size)
+    return _flat(rng, size)
+
+
+def _save_params(kind, rng):
+    if kind in ('photo', 'web'):
+        return {'quality': rng.randrange(80, 98)}
+    if kind == 'large':
+        return {'compression': None}
+    return {}
+
+
+def generate_corpus(output_dir, scale='small', seed=1234):
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    settings = {'version': CORPUS_VERSION, 'scale': scale, 'seed': seed}
+    
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['settings'] == settings:
+            return manifest
+    
+    os.makedirs(output_dir, exist_ok=True)
+    rng = random.Random(seed)
+    files = []
+    
+    for kind, file_format, extension, sizes in CORPUS_SPEC:
+        for width, height in sizes:
+            for index in range(COUNTS[scale]):
+                filename = f"{kind}_{width}x{height}_{index}{extension}"
+                img = _make_image(kind, rng, (width, height))
+                img.save(os.path.join(output_dir, filename), file_format, **_save_params(kind, rng))
+                files.append(filename)
+    
+    digest = hashlib.sha256()
+    for filename in files:
+        with open(os.path.join(output_dir, filename), 'rb') as f:
+            digest.update(f.read())
+    
+    manifest = {
+        'settings': settings,
+        'files': files,
+        'total_bytes': sum(os.path.getsize(os.path.join(output_dir, name)) for name in files),
+        'sha256': digest.hexdigest(),
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the deterministic benchmark corpus.")
+    parser.add_argument("--scale", choices=sorted(COUNTS), default="small")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="corpus folder (default: a folder in the temp directory)")
+    args = parser.parse_args()
+    
+    output_dir = args.output or default_corpus_dir(args.scale)
+    manifest = generate_corpus(output_dir, args.scale, args.seed)
+    print(f"{len(manifest['files'])} images, {manifest['total_bytes'] / 1024 / 1024:.1f} MB "
+          f"in {output_dir} (sha256 {manifest['sha256'][:12]})")
+
+
+if __name__ == "__main__":
+    main()
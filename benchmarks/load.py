@@ -0,0 +1,94 @@
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run import percentile
+
+
+def client(url, payload, deadline, results):
+    # One keep-alive connection per client, reused for every request it sends.
+    target = urlsplit(url)
+    path = f"{target.path}?{target.query}" if target.query else target.path
+    connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+    latencies, statuses, output_bytes = [], {}, 0
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            connection.request('POST', path, body=payload, headers={'Content-Type': 'application/octet-stream'})
+            response = connection.getresponse()
+            body = response.read()
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+            if response.status == 200:
+                output_bytes += len(body)
+    finally:
+        connection.close()
+        results.append((latencies, statuses, output_bytes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send images to the compression service and measure it.")
+    parser.add_argument("image", help="file to upload with every request")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/compress?mode=compress&quality=80")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel keep-alive connections (default: 4)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run (default: 10)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    
+    with open(args.image, 'rb') as f:
+        payload = f.read()
+    
+    results = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=client, args=(args.url, payload, deadline, results))
+        for _ in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    
+    latencies = [latency for client_latencies, _, _ in results for latency in client_latencies]
+    statuses = {}
+    for _, client_statuses, _ in results:
+        for status, count in client_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    succeeded = statuses.get(200, 0)
+    
+    summary = {
+        'requests': len(latencies),
+        'succeeded': succeeded,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'seconds': elapsed,
+        'requests_per_sec': succeeded / elapsed if elapsed else 0.0,
+        'mb_in_per_sec': succeeded * len(payload) / 1024 / 1024 / elapsed if elapsed else 0.0,
+        'output_bytes_per_request': sum(output for _, _, output in results) / succeeded if succeeded else 0,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p90': percentile(latencies, 0.90),
+        'latency_p99': percentile(latencies, 0.99),
+    }
+    if args.json:
+        print(json.dumps(summary))
+        return 0
+    
+    print(f"{summary['requests']} requests in {elapsed:.1f}s over {args.concurrency} connections, "
+          f"statuses {summary['statuses']}")
+    print(f"{summary['requests_per_sec']:.1f} req/s, {summary['mb_in_per_sec']:.1f} MB/s in, "
+          f"{len(payload) / 1024:.1f} KB -> {summary['output_bytes_per_request'] / 1024:.1f} KB")
+    print(f"latency p50 {summary['latency_p50'] * 1000:.1f} ms, p90 {summary['latency_p90'] * 1000:.1f} ms, "
+          f"p99 {summary['latency_p99'] * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import COUNTS, default_corpus_dir, generate_corpus
+
+
+# Keyword arguments for BatchEngine, per benchmark case.
+CASES = {
+    'optimize': {},
+    'compress': {'compress': True, 'quality': 75},
+    'target': {'target_percent': 50},
+    'resize': {'compress': True, 'quality': 80, 'max_width': 1600},
+    'png-fast': {'png_effort': 'fast'},
+    'png-default': {'png_effort': 'default'},
+    'png-max': {'png_effort': 'max'},
+}
+
+# Cases that only make sense on part of the corpus, as include globs.
+CASE_INCLUDE = {
+    'png-fast': ['*.png', '*.bmp'],
+    'png-default': ['*.png', '*.bmp'],
+    'png-max': ['*.png', '*.bmp'],
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def run_case(name, corpus_dir, workers):
+    from engine import BatchEngine
+    from metrics import Metrics, MetricsAggregator
+    from utils import FileOperations
+    
+    with tempfile.TemporaryDirectory() as output_dir:
+        jobs = list(FileOperations().iter_jobs(corpus_dir, output_dir, include=CASE_INCLUDE.get(name)))
+        aggregator = MetricsAggregator()
+        engine = BatchEngine(workers=workers, metrics=Metrics([aggregator]), **CASES[name])
+        
+        start = time.perf_counter()
+        results = list(engine.run(jobs))
+        elapsed = time.perf_counter() - start
+    
+    succeeded = [result for result in results if result.success]
+    latencies = [result.elapsed for result in succeeded]
+    input_bytes = sum(result.original_size for result in succeeded)
+    encode = aggregator.summary()['stages'].get('encode', {}).get('all', {})
+    output_bytes = sum(result.new_size for result in succeeded)
+    
+    return {
+        'images': len(results),
+        'failed': len(results) - len(succeeded),
+        'seconds': elapsed,
+        'images_per_sec': len(results) / elapsed if elapsed else 0.0,
+        'mb_per_sec': input_bytes / 1024 / 1024 / elapsed if elapsed else 0.0,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p90': percentile(latencies, 0.90),
+        'latency_p99': percentile(latencies, 0.99),
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'bytes_saved': input_bytes - output_bytes,
+        # Summed over every worker, so it can exceed the wall-clock seconds.
+        'encode_seconds': encode.get('total', 0.0),
+    }
+
+
+def run_isolated(name, corpus_dir, workers):
+    # Each case runs in its own interpreter so wait4() reports the peak RSS of that
+    # case alone, pool workers included.
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--case', name,
+         '--corpus', corpus_dir, '--workers', str(workers)],
+        stdout=subprocess.PIPE
+    )
+    output = process.stdout.read()
+    process.stdout.close()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError(f"Benchmark case {name} exited with status {process.returncode}")
+    
+    metrics = json.loads(output)
+    metrics['peak_rss_mb'] = usage.ru_maxrss / 1024
+    return metrics
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, metrics in results['cases'].items():
+        previous = baseline['cases'].get(name)
+        if not previous:
+            continue
+        
+        speed_change = (metrics['images_per_sec'] / previous['images_per_sec'] - 1) * 100
+        latency_change = (metrics['latency_p90'] / previous['latency_p90'] - 1) * 100 if previous['latency_p90'] else 0.0
+        size_change = (metrics['output_bytes'] / previous['output_bytes'] - 1) * 100 if previous['output_bytes'] else 0.0
+        print(f"{name:<12} throughput {speed_change:+6.1f}%  p90 latency {latency_change:+6.1f}%  "
+              f"output size {size_change:+6.1f}%")
+        
+        if speed_change < -threshold:
+            regressions.append(f"{name}: throughput down {-speed_change:.1f}%")
+        if latency_change > threshold:
+            regressions.append(f"{name}: p90 latency up {latency_change:.1f}%")
+    return regressions
+
+
+def print_table(results):
+    print(f"{'case':<12}{'img/s':>9}{'MB/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}"
+          f"{'RSS MB':>9}{'out MB':>9}{'saved MB':>10}{'encode s':>10}{'failed':>8}")
+    for name, metrics in results['cases'].items():
+        print(f"{name:<12}{metrics['images_per_sec']:>9.1f}{metrics['mb_per_sec']:>9.1f}"
+              f"{metrics['latency_p50'] * 1000:>9.1f}{metrics['latency_p90'] * 1000:>9.1f}"
+              f"{metrics['latency_p99'] * 1000:>9.1f}{metrics['peak_rss_mb']:>9.1f}"
+              f"{metrics['output_bytes'] / 1024 / 1024:>9.2f}{metrics['bytes_saved'] / 1024 / 1024:>10.2f}"
+              f"{metrics.get('encode_seconds', 0.0):>10.2f}{metrics['failed']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing modes on a synthetic corpus.")
+    parser.add_argument("--scale", choices=sorted(COUNTS), default="small")
+    parser.add_argument("--corpus", help="corpus folder (default: generated in the temp directory)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--output", default="benchmark-results.json", help="where to write the results JSON")
+    parser.add_argument("--baseline", help="results JSON from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="allowed slowdown in percent before a case counts as a regression")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.case:
+        print(json.dumps(run_case(args.case, args.corpus, args.workers)))
+        return 0
+    
+    corpus_dir = args.corpus or default_corpus_dir(args.scale)
+    manifest = generate_corpus(corpus_dir, args.scale)
+    
+    from PIL import __version__ as pillow_version
+    
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': pillow_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'workers': args.workers,
+            'corpus': manifest['settings'],
+            'corpus_sha256': manifest['sha256'],
+            'corpus_bytes': manifest['total_bytes'],
+        },
+        'cases': {name: run_isolated(name, corpus_dir, args.workers) for name in args.cases},
+    }
+    
+    print_table(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    
+    if not args.baseline:
+        return 0
+    
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['meta']['corpus_sha256'] != results['meta']['corpus_sha256']:
+        print("Warning: baseline was measured on a different corpus")
+    
+    print(f"\nCompared with {args.baseline}:")
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
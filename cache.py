@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+from PIL import __version__ as PIL_VERSION
+
+from pipeline import temp_path_for
+
+
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "image_size_reducer")
+
+
+class ResultCache:
+    
+    HASH_BLOCK_SIZE = 1024 * 1024
+    
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.max_bytes = max_bytes
+        os.makedirs(self.objects_dir, exist_ok=True)
+        
+        # Workers share one index, so wait on each other's locks instead of failing.
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), timeout=60,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, size INTEGER, last_used REAL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO meta VALUES ('total_bytes', 0);
+        """)
+    
+    def close(self):
+        self.db.close()
+    
+    def source_digest(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.db.execute(
+            "SELECT digest FROM sources WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns)
+        ).fetchone()
+        if row:
+            return row[0]
+        
+        digest = hashlib.blake2b()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(self.HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        digest = digest.hexdigest()
+        
+        self.db.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, digest)
+        )
+        return digest
+    
+    def make_key(self, input_path, output_path, settings):
+        # Output extension picks the encoder, so it is part of the settings being cached.
+        params = {
+            "cache_version": CACHE_VERSION,
+            "pillow": PIL_VERSION,
+            "output_ext": os.path.splitext(output_path)[1].lower(),
+            "settings": settings,
+        }
+        material = self.source_digest(input_path) + json.dumps(params, sort_keys=True)
+        return hashlib.blake2b(material.encode(), digest_size=20).hexdigest()
+    
+    def fetch(self, key, output_path):
+        blob_path = self._blob_path(key)
+        cursor = self.db.execute(
+            "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        if not cursor.rowcount:
+            return False
+        
+        # Copied under a temporary name like every other output, so an interrupted
+        # copy never leaves a truncated file that looks finished.
+        tmp_path = temp_path_for(output_path)
+        try:
+            shutil.copyfile(blob_path, tmp_path)
+            os.replace(tmp_path, output_path)
+        except FileNotFoundError:
+            self._forget(key)
+            return False
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+        return True
+    
+    def store(self, key, output_path):
+        blob_path = self._blob_path(key)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        
+        tmp_path = f"{blob_path}.{os.getpid()}.tmp"
+        try:
+            shutil.copyfile(output_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+        size = os.path.getsize(blob_path)
+        
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            delta = size - (row[0] if row else 0)
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, size, time.time())
+            )
+            self.db.execute(
+                "UPDATE meta SET value = value + ? WHERE name = 'total_bytes'", (delta,)
+            )
+            evicted = self._evict()
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        
+        for evicted_key in evicted:
+            try:
+                os.remove(self._blob_path(evicted_key))
+            except FileNotFoundError:
+                pass
+    
+    def _evict(self):
+        total = self.db.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        
+        evicted = []
+        cursor = self.db.execute("SELECT key, size FROM entries ORDER BY last_used")
+        for key, size in cursor:
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        cursor.close()
+        
+        self.db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+        self.db.execute("UPDATE meta SET value = ? WHERE name = 'total_bytes'", (total,))
+        return evicted
+    
+    def _forget(self, key):
+        self.db.execute("BEGIN IMMEDIATE")
+        row = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.db.execute(
+                "UPDATE meta SET value = value - ? WHERE name = 'total_bytes'", (row[0],)
+            )
+        self.db.execute("COMMIT")
+    
+    def _blob_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
@@ -0,0 +1,370 @@
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+from itertools import chain, islice
+
+from archive_formats import is_archive
+from engine import BatchEngine
+from metrics import JsonLinesSink, Metrics, MetricsAggregator
+from processor import DEFAULT_MIN_PSNR, PNG_EFFORT, OutputVariant
+from utils import FileOperations
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="image-size-reducer",
+        description="Reduce image file sizes without a GUI."
+    )
+    parser.add_argument("input", help="folder, or ZIP/TAR archive, containing the source images")
+    parser.add_argument("output", nargs="?",
+                        help="output folder, or archive ending in .zip/.tar/.tar.gz/... "
+                             "(default: <input>/reduced_images, or <name>_reduced.zip for an archive)")
+    parser.add_argument(
+        "--mode", choices=("optimize", "compress", "target"), default="optimize",
+        help="optimize without quality loss, compress with --quality, "
+             "or search for the quality that meets a target size (default: optimize)"
+    )
+    parser.add_argument("--quality", type=int, default=85, help="JPEG quality for compress mode (default: 85)")
+    parser.add_argument("--target-kb", type=float, help="target mode: maximum output size in KB")
+    parser.add_argument("--target-percent", type=float,
+                        help="target mode: maximum output size as a percentage of the original")
+    parser.add_argument("--png-effort", choices=sorted(PNG_EFFORT), default="default",
+                        help="PNG compression effort: fast (zlib level 1, RLE), default (level 9 with "
+                             "per-row filters) or max (smallest of several strategies) (default: default)")
+    parser.add_argument("--auto-format", action="store_true",
+                        help="write each image as whichever of JPEG, WebP or PNG is smallest; in optimize "
+                             "mode only lossless candidates are tried")
+    parser.add_argument("--quality-floor", type=float, default=DEFAULT_MIN_PSNR, metavar="DB",
+                        help="auto format: minimum PSNR a lossy candidate must reach (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--max-width", type=int, help="downscale images wider than this many pixels")
+    parser.add_argument("--max-height", type=int, help="downscale images taller than this many pixels")
+    parser.add_argument("--max-megapixels", type=float, help="downscale images larger than this many megapixels")
+    parser.add_argument(
+        "--variant", action="append", type=OutputVariant.parse, metavar="SPEC",
+        help="write this output per image instead of a single one; all variants share one "
+             "decode, e.g. 'max_width=800,format=webp,quality=80,suffix=_800' (repeatable)"
+    )
+    parser.add_argument("--dedup", nargs="?", const="link", choices=("link", "copy"),
+                        help="encode byte-identical sources once and hard-link (default) or copy "
+                             "that output for the others")
+    parser.add_argument("--hardlink-unchanged", action="store_true",
+                        help="hard-link sources that cannot be made smaller instead of copying them")
+    parser.add_argument("--no-recursive", dest="recursive", action="store_false",
+                        help="only process images directly inside the input folder")
+    parser.add_argument("--include", action="append", metavar="GLOB",
+                        help="only process files matching this glob (repeatable)")
+    parser.add_argument("--exclude", action="append", metavar="GLOB",
+                        help="skip files and folders matching this glob (repeatable)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from the journal in the output folder, "
+                             "skipping files it already finished")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and reduce images as they appear in the input folder")
+    parser.add_argument("--poll-interval", type=float, default=0.25, metavar="SECONDS",
+                        help="watch mode: how often to check for new files (default: 0.25)")
+    parser.add_argument("--settle-seconds", type=float, default=0.5,
+                        help="watch mode: how long a file must go unmodified before it is processed "
+                             "(default: 0.5)")
+    parser.add_argument("--full-scan-seconds", type=float, default=60.0,
+                        help="watch mode: how often every known file is re-checked for changes made "
+                             "in place (default: 60)")
+    parser.add_argument("--coordinate", metavar="HOST:PORT",
+                        help="hand the jobs out to worker nodes started with 'cluster.py HOST:PORT' "
+                             "instead of processing them here")
+    parser.add_argument("--lease-timeout", type=float, default=300.0, metavar="SECONDS",
+                        help="coordinate: re-issue a node's jobs when it sends no result for this long "
+                             "(default: 300)")
+    parser.add_argument("--cache-dir", help="reuse earlier outputs from this result cache")
+    parser.add_argument("--cache-size-mb", type=int, default=1024, help="result cache size limit (default: 1024)")
+    parser.add_argument("--io-threads", type=int, default=4,
+                        help="threads per worker prefetching source files; 0 reads inline (default: 4)")
+    parser.add_argument("--memory-budget-mb", type=int,
+                        help="limit the estimated memory of images being processed at once")
+    parser.add_argument("--metrics-jsonl", metavar="PATH",
+                        help="append per-file stage timings to this JSON-lines file")
+    parser.add_argument("--metrics", action="store_true",
+                        help="include per-stage timing histograms in the summary")
+    parser.add_argument("--estimate", action="store_true",
+                        help="only estimate output size, savings and run time from a sample of the "
+                             "input, without processing it")
+    parser.add_argument("--ordered", action="store_true", help="report results in input order")
+    parser.add_argument("--json", action="store_true", help="print a machine-readable summary to stdout")
+    parser.add_argument("--quiet", action="store_true", help="do not log individual files")
+    return parser
+
+
+def run(args):
+    if args.mode == "target" and not (args.target_kb or args.target_percent):
+        raise SystemExit("--mode target needs --target-kb or --target-percent")
+    
+    target_bytes = target_percent = None
+    if args.mode == "target":
+        target_bytes = args.target_kb * 1024 if args.target_kb else None
+        target_percent = None if target_bytes else args.target_percent
+    
+    metrics = aggregator = None
+    if args.metrics or args.metrics_jsonl:
+        sinks = []
+        if args.metrics:
+            aggregator = MetricsAggregator()
+            sinks.append(aggregator)
+        if args.metrics_jsonl:
+            sinks.append(JsonLinesSink(args.metrics_jsonl))
+        metrics = Metrics(sinks)
+    
+    from_archive = is_archive(args.input) and os.path.isfile(args.input)
+    if from_archive:
+        import archive
+        
+        output_folder = args.output or archive.default_output_for(args.input)
+    else:
+        output_folder = args.output or os.path.join(args.input, "reduced_images")
+        if not os.path.isdir(args.input):
+            raise SystemExit(f"Input folder does not exist: {args.input}")
+    
+    streamed = from_archive or is_archive(output_folder)
+    if streamed and (args.watch or args.resume or args.variant or args.coordinate or args.dedup):
+        raise SystemExit("--watch, --resume, --variant, --coordinate and --dedup cannot be used with archives")
+    if args.watch and args.coordinate:
+        raise SystemExit("--watch cannot be used with --coordinate")
+    if not is_archive(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+    
+    engine_options = dict(
+        compress=args.mode == "compress",
+        quality=args.quality,
+        ordered=args.ordered,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=args.cache_size_mb * 1024 * 1024,
+        target_bytes=target_bytes,
+        target_percent=target_percent,
+        hardlink_unchanged=args.hardlink_unchanged,
+        max_width=args.max_width,
+        max_height=args.max_height,
+        max_megapixels=args.max_megapixels,
+        variants=args.variant,
+        memory_budget=args.memory_budget_mb * 1024 * 1024 if args.memory_budget_mb else None,
+        metrics=metrics,
+        io_threads=args.io_threads,
+        auto_format=args.auto_format,
+        min_psnr=args.quality_floor,
+        png_effort=args.png_effort,
+        dedup=args.dedup
+    )
+    journal = output = coordinator = deduplicator = engine = None
+    if streamed:
+        import archive
+        
+        # Images go straight from the input archive or folder into the output, with no staging on disk.
+        if from_archive:
+            members = archive.iter_members(args.input, args.include, args.exclude)
+        else:
+            members = archive.iter_folder(args.input, args.recursive, args.include, args.exclude)
+        workers = args.workers or os.cpu_count() or 1
+        engine = BatchEngine(workers=workers, **engine_options)
+        output = archive.open_output(output_folder)
+        results = archive.process_archive(engine, args.input, output, members)
+    elif args.watch:
+        workers = args.workers or os.cpu_count() or 1
+        results = _watch(args, output_folder, engine_options, workers)
+    else:
+        from journal import JobJournal
+        
+        output_settings = BatchEngine(**engine_options).output_settings()
+        try:
+            journal = JobJournal(output_folder, args.input, output_settings, resume=args.resume)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        
+        # Absolute paths keep the journal valid when a resume starts from another directory.
+        jobs = journal.jobs(FileOperations().iter_jobs(
+            os.path.abspath(args.input), os.path.abspath(output_folder),
+            args.recursive, args.include, args.exclude
+        ))
+        
+        if args.coordinate:
+            from cluster import Coordinator, parse_address
+            
+            # Nodes build their own engines from these; metrics, ordering and
+            # dedup stay here, where every job is seen.
+            settings = {key: value for key, value in engine_options.items()
+                        if key not in ("metrics", "ordered", "dedup")}
+            settings["variants"] = [variant.to_dict() for variant in args.variant or ()]
+            if args.dedup:
+                from dedup import Deduplicator
+                
+                deduplicator = Deduplicator(args.dedup)
+                jobs = deduplicator.jobs(jobs)
+            coordinator = Coordinator(
+                jobs, parse_address(args.coordinate), settings,
+                lease_timeout=args.lease_timeout, metrics=metrics
+            )
+            print(f"Waiting for worker nodes on {args.coordinate}", file=sys.stderr)
+            workers = 0
+            results = coordinator.run()
+            if deduplicator is not None:
+                results = deduplicator.results(results)
+        else:
+            # A pool only pays off when there is more than one file to spread across it.
+            first_jobs = list(islice(jobs, 2))
+            workers = args.workers or os.cpu_count() or 1
+            if len(first_jobs) < 2:
+                workers = 1
+            jobs = chain(first_jobs, jobs)
+            engine = BatchEngine(workers=workers, **engine_options)
+            results = engine.run(jobs)
+    
+    summary = {
+        "input_folder": args.input,
+        "output_folder": output_folder,
+        "mode": args.mode,
+        "quality": args.quality,
+        "workers": workers,
+        "resumed": journal.resumed if journal else 0,
+        "total": 0,
+        "succeeded": 0,
+        "cached": 0,
+        "unchanged": 0,
+        "failed": 0,
+        "original_bytes": 0,
+        "output_bytes": 0,
+        "trial_encodes": 0,
+        "duplicates": 0,
+        "failures": [],
+    }
+    started = time.perf_counter()
+    summary["startup_seconds"] = round(started - _START, 4)
+    
+    try:
+        for result in results:
+            if journal is not None:
+                journal.record(result)
+            _add_result(summary, result, args.quiet)
+    except KeyboardInterrupt:
+        # Ctrl-C is how a watch ends; a batch run still reports it as an error.
+        if not args.watch:
+            if output is not None:
+                output.abort()
+            raise
+    finally:
+        if journal is not None:
+            journal.close()
+    if output is not None:
+        output.close()
+    
+    summary["elapsed_seconds"] = round(time.perf_counter() - started, 4)
+    if engine is not None:
+        deduplicator = engine.deduplicator
+    if deduplicator is not None:
+        summary["dedup_hashed"] = deduplicator.hashed
+        summary["dedup_seconds_saved"] = round(deduplicator.seconds_saved, 4)
+    if coordinator is not None:
+        summary["nodes"] = coordinator.node_stats()
+        summary["workers"] = sum(node["workers"] or 0 for node in summary["nodes"].values())
+    if metrics is not None:
+        metrics.close()
+    if aggregator is not None:
+        summary["metrics"] = aggregator.summary()
+    return summary
+
+
+def _add_result(summary, result, quiet):
+    summary["total"] += 1
+    if not result.success:
+        summary["failed"] += 1
+        summary["failures"].append({"file": result.input_path, "error": result.error})
+        return
+    
+    summary["succeeded"] += 1
+    summary["cached"] += result.cached
+    summary["trial_encodes"] += result.trials
+    summary["unchanged"] += result.action in ("passthrough", "skipped")
+    summary["duplicates"] += result.action == "duplicate"
+    summary["original_bytes"] += result.original_size
+    summary["output_bytes"] += result.new_size
+    if quiet:
+        return
+    
+    detail = ""
+    if result.quality is not None:
+        detail = f" at quality {result.quality} after {result.trials} trials"
+    elif result.trials:
+        detail = f" as {os.path.basename(result.output_path)} after {result.trials} trials"
+    elif result.action == "duplicate":
+        detail = " (duplicate, not re-encoded)"
+    print(f"{result.filename}: {result.original_size/1024:.1f} KB -> "
+          f"{result.new_size/1024:.1f} KB ({result.reduction:.1f}%){detail}",
+          file=sys.stderr)
+
+
+def _watch(args, output_folder, engine_options, workers):
+    from watcher import FolderWatcher
+    
+    watcher = FolderWatcher(
+        args.input, output_folder, args.recursive, args.include, args.exclude,
+        poll_interval=args.poll_interval, settle_time=args.settle_seconds,
+        full_scan_interval=args.full_scan_seconds
+    )
+    
+    def process(jobs):
+        # A single arrival runs in-process; a pool is only started for a burst of files.
+        engine = BatchEngine(workers=min(workers, len(jobs)), **engine_options)
+        return engine.run(jobs)
+    
+    print(f"Watching {args.input} for new images (Ctrl-C to stop)", file=sys.stderr)
+    return watcher.run(process)
+
+
+def estimate(args):
+    if (args.mode == "target" or args.variant or args.auto_format
+            or args.max_width or args.max_height or args.max_megapixels):
+        raise SystemExit("--estimate supports optimize and compress modes without resizing")
+    if not os.path.isdir(args.input):
+        raise SystemExit(f"Input folder does not exist: {args.input}")
+    
+    from estimate import SavingsEstimator
+    
+    estimator = SavingsEstimator(args.input, args.output or os.path.join(args.input, "reduced_images"),
+                                 recursive=args.recursive, include=args.include, exclude=args.exclude,
+                                 workers=args.workers)
+    return estimator.estimate(args.mode == "compress", args.quality)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.estimate:
+        result = estimate(args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"Estimated {result['original_bytes'] / 1024 / 1024:.1f} MB -> "
+                  f"{result['output_bytes'] / 1024 / 1024:.1f} MB ({result['saved_percent']:.1f}% smaller) "
+                  f"in about {result['seconds']:.0f}s for {result['files']} images, "
+                  f"from {result['sampled']} samples")
+        return 0
+    
+    # Per-file errors are printed by the processor; keep stdout for the summary alone.
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = run(args)
+    
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print(f"Processed {summary['total']} images, reduced {summary['succeeded']}, "
+              f"failed {summary['failed']} in {summary['elapsed_seconds']:.2f}s")
+        if summary["duplicates"]:
+            print(f"Skipped {summary['duplicates']} encodes of duplicate images, "
+                  f"saving about {summary['dedup_seconds_saved']:.2f}s")
+    
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,374 @@
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from engine import JobResult
+
+
+RESULT_FIELDS = (
+    'input_path', 'output_path', 'success', 'original_size', 'new_size', 'elapsed',
+    'error', 'cached', 'quality', 'trials', 'action', 'outputs', 'timings',
+)
+
+
+def parse_address(value, default_host='127.0.0.1'):
+    host, _, port = value.rpartition(':')
+    return host or default_host, int(port)
+
+
+class Connection:
+    
+    # One JSON object per line in each direction; every request gets one reply.
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.writer = sock.makefile('wb')
+    
+    def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b'\n')
+        self.writer.flush()
+    
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        return json.loads(line)
+    
+    def call(self, message):
+        self.send(message)
+        return self.receive()
+    
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+        self.sock.close()
+
+
+class Lease:
+    
+    def __init__(self, lease_id, worker, jobs, deadline):
+        self.id = lease_id
+        self.worker = worker
+        self.jobs = dict(jobs)
+        self.deadline = deadline
+
+
+class Coordinator:
+    
+    def __init__(self, jobs, address=('127.0.0.1', 9100), settings=None, lease_timeout=300.0,
+                 poll_interval=0.5, linger=2.0, buffer_size=4096, metrics=None):
+        self.scan = iter(jobs)
+        self.buffer_size = buffer_size
+        self.address = address
+        self.settings = settings or {}
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.linger = linger
+        self.metrics = metrics
+        
+        self.lock = threading.Lock()
+        self.scan_done = False
+        # Jobs ready to lease: re-issued ones at the front, then a window of the scan.
+        self.ready = deque()
+        self.leases = {}
+        self.next_lease = 0
+        self.finished = set()
+        self.nodes = {}
+        self.connected = 0
+        self.results = queue.Queue()
+        self.done = threading.Event()
+        self.server = None
+    
+    def run(self):
+        self._refill()
+        if not self.ready:
+            return
+        
+        self.server = _CoordinatorServer(self.address, self)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    result = self.results.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    # Leases of workers that hang without disconnecting run out here.
+                    with self.lock:
+                        self._expire_leases()
+                    self._refill()
+                    continue
+                self._refill()
+                if result is None:
+                    break
+                if self.metrics is not None:
+                    self.metrics.record(result)
+                yield result
+        finally:
+            self.done.set()
+            # Idle workers are told the run is over the next time they ask for work.
+            deadline = time.monotonic() + self.linger
+            while self.connected and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.server.shutdown()
+            self.server.server_close()
+    
+    def node_stats(self):
+        with self.lock:
+            nodes = {}
+            for name, stats in self.nodes.items():
+                stats = dict(stats)
+                active = stats.pop('last_result') - stats.pop('first_lease')
+                stats['images_per_sec'] = stats['files'] / active if active > 0 else 0.0
+                nodes[name] = stats
+            return nodes
+    
+    def handle(self, worker, message):
+        op = message.get('op')
+        with self.lock:
+            if op == 'hello':
+                return self._hello(message)
+            if worker is None:
+                return {'error': 'say hello first'}
+            if op == 'lease':
+                return self._lease(worker, max(1, int(message.get('max', 1))))
+            if op == 'result':
+                return self._result(worker, message['lease'], message['result'])
+        return {'error': f'unknown op: {op}'}
+    
+    def disconnect(self, worker):
+        with self.lock:
+            self.connected -= 1
+            if worker is None:
+                return
+            self.nodes[worker]['connected'] = False
+            # Only the dead worker's unfinished jobs go back in the queue.
+            for lease in [lease for lease in self.leases.values() if lease.worker == worker]:
+                self._reissue(lease)
+    
+    def _hello(self, message):
+        name = message.get('worker') or 'worker'
+        worker = name
+        suffix = 1
+        while worker in self.nodes and self.nodes[worker]['connected']:
+            suffix += 1
+            worker = f"{name}-{suffix}"
+        stats = self.nodes.setdefault(worker, {
+            'workers': message.get('workers'), 'leases': 0, 'files': 0, 'succeeded': 0, 'failed': 0,
+            'original_bytes': 0, 'output_bytes': 0, 'busy_seconds': 0.0, 'reissued': 0,
+            'first_lease': 0.0, 'last_result': 0.0,
+        })
+        stats['connected'] = True
+        return {'worker': worker, 'settings': self.settings}
+    
+    def _lease(self, worker, size):
+        self._expire_leases()
+        if self.done.is_set():
+            return {'done': True}
+        
+        jobs = []
+        while self.ready and len(jobs) < size:
+            job = self.ready.popleft()
+            # A late result from the original holder may already have finished it.
+            if job[0] not in self.finished:
+                jobs.append(job)
+        
+        if not jobs:
+            self._check_complete()
+            return {'done': True} if self.done.is_set() else {'wait': self.poll_interval}
+        
+        self.next_lease += 1
+        now = time.monotonic()
+        lease = self.leases[self.next_lease] = Lease(self.next_lease, worker, jobs, now + self.lease_timeout)
+        stats = self.nodes[worker]
+        stats['leases'] += 1
+        stats['first_lease'] = stats['first_lease'] or now
+        return {'lease': lease.id, 'jobs': jobs}
+    
+    def _result(self, worker, lease_id, fields):
+        now = time.monotonic()
+        input_path = fields['input_path']
+        lease = self.leases.get(lease_id)
+        if lease is not None:
+            lease.jobs.pop(input_path, None)
+            if not lease.jobs:
+                del self.leases[lease_id]
+        # Any result shows the worker is alive, so all of its leases are extended.
+        for held in self.leases.values():
+            if held.worker == worker:
+                held.deadline = now + self.lease_timeout
+        
+        if input_path not in self.finished:
+            self.finished.add(input_path)
+            result = JobResult(**fields)
+            stats = self.nodes[worker]
+            stats['files'] += 1
+            stats['succeeded' if result.success else 'failed'] += 1
+            stats['original_bytes'] += result.original_size
+            stats['output_bytes'] += result.new_size
+            stats['busy_seconds'] += result.elapsed
+            stats['last_result'] = now
+            self.results.put(result)
+        
+        self._check_complete()
+        return {'ok': True}
+    
+    def _expire_leases(self):
+        now = time.monotonic()
+        for lease in [lease for lease in self.leases.values() if lease.deadline < now]:
+            self._reissue(lease)
+    
+    def _reissue(self, lease):
+        del self.leases[lease.id]
+        jobs = [job for job in lease.jobs.items() if job[0] not in self.finished]
+        self.nodes[lease.worker]['reissued'] += len(jobs)
+        self.ready.extendleft(reversed(jobs))
+    
+    def _refill(self):
+        # The scan (and any journal wrapped around it) is only ever advanced from the
+        # thread running run(), a window at a time; workers lease from the buffer.
+        if self.scan_done:
+            return
+        with self.lock:
+            wanted = self.buffer_size - len(self.ready)
+        if wanted <= 0:
+            return
+        more = [(str(input_path), str(output_path)) for input_path, output_path in islice(self.scan, wanted)]
+        with self.lock:
+            self.ready.extend(more)
+            if len(more) < wanted:
+                self.scan_done = True
+                self._check_complete()
+    
+    def _check_complete(self):
+        if self.done.is_set() or not self.scan_done or self.leases:
+            return
+        if any(job[0] not in self.finished for job in self.ready):
+            return
+        self.done.set()
+        self.results.put(None)
+
+
+class _CoordinatorHandler(socketserver.StreamRequestHandler):
+    
+    disable_nagle_algorithm = True
+    
+    def handle(self):
+        coordinator = self.server.coordinator
+        connection = Connection(self.request)
+        worker = None
+        with coordinator.lock:
+            coordinator.connected += 1
+        try:
+            while True:
+                try:
+                    message = connection.receive()
+                except (ConnectionError, OSError, ValueError):
+                    return
+                reply = coordinator.handle(worker, message)
+                worker = reply.get('worker', worker)
+                connection.send(reply)
+        except OSError:
+            pass
+        finally:
+            coordinator.disconnect(worker)
+
+
+class _CoordinatorServer(socketserver.ThreadingTCPServer):
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, address, coordinator):
+        self.coordinator = coordinator
+        super().__init__(address, _CoordinatorHandler)
+
+
+def run_worker(address, workers=None, name=None, cache_dir=None):
+    # Pulls leases from the coordinator and feeds them to one BatchEngine, so the
+    # pool stays busy across leases; results go back one by one as they finish.
+    from engine import BatchEngine
+    from processor import OutputVariant
+    
+    workers = max(1, workers or os.cpu_count() or 1)
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connection = Connection(sock)
+    processed = 0
+    try:
+        hello = connection.call({
+            'op': 'hello', 'worker': name or f"{socket.gethostname()}:{os.getpid()}", 'workers': workers
+        })
+        options = dict(hello['settings'])
+        options['variants'] = [OutputVariant(**variant) for variant in options.get('variants') or ()]
+        if cache_dir:
+            options['cache_dir'] = cache_dir
+        engine = BatchEngine(workers=workers, **options)
+        print(f"Joined {address[0]}:{address[1]} as {hello['worker']} with {engine.workers} workers",
+              file=sys.stderr)
+        
+        leases = {}
+        for result in engine.run(_leased_jobs(connection, engine, leases)):
+            fields = {field: getattr(result, field) for field in RESULT_FIELDS}
+            connection.call({'op': 'result', 'lease': leases.pop(result.input_path), 'result': fields})
+            processed += 1
+        return processed
+    except ConnectionError:
+        # The coordinator is gone; whatever this worker still held will be re-issued.
+        return processed
+    finally:
+        connection.close()
+
+
+def _leased_jobs(connection, engine, leases):
+    # Asking for about one chunk per pool worker at a time keeps each lease small,
+    # so a dead node only ever strands a little work. The run only ends when the
+    # coordinator says so; while it has nothing to hand out, the engine is told
+    # to finish what it holds, and the coordinator is asked again after its wait.
+    size = engine.workers * engine.chunksize
+    created_dirs = set()
+    while True:
+        reply = connection.call({'op': 'lease', 'max': size})
+        if reply.get('done'):
+            return
+        if 'jobs' not in reply:
+            yield None
+            if not leases:
+                time.sleep(reply.get('wait', 0.5))
+            continue
+        for input_path, output_path in reply['jobs']:
+            output_dir = os.path.dirname(output_path)
+            if output_dir not in created_dirs:
+                os.makedirs(output_dir, exist_ok=True)
+                created_dirs.add(output_dir)
+            leases[input_path] = reply['lease']
+            yield input_path, output_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Join a coordinator started with 'cli.py ... --coordinate HOST:PORT' and process its jobs."
+    )
+    parser.add_argument("coordinator", help="coordinator address as HOST:PORT")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes on this node (default: one per CPU)")
+    parser.add_argument("--name", help="name reported in the coordinator's stats (default: host:pid)")
+    parser.add_argument("--cache-dir", help="result cache on this node, overriding the coordinator's")
+    args = parser.parse_args(argv)
+    
+    try:
+        processed = run_worker(parse_address(args.coordinator), args.workers, args.name, args.cache_dir)
+    except OSError as e:
+        raise SystemExit(f"Cannot reach coordinator {args.coordinator}: {e}")
+    print(f"Processed {processed} images", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
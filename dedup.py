@@ -0,0 +1,146 @@
+import hashlib
+import os
+import shutil
+import time
+from collections import deque
+
+from engine import JobResult
+from pipeline import temp_path_for
+
+
+class Deduplicator:
+    
+    HASH_BLOCK_SIZE = 1024 * 1024
+    
+    def __init__(self, mode='link'):
+        # 'link' hard-links a duplicate's outputs to the representative's, falling
+        # back to a copy across filesystems; 'copy' always writes separate files.
+        self.mode = mode
+        # The first file of each size, until a second one makes hashing it worthwhile.
+        self.by_size = {}
+        self.by_digest = {}
+        self.digests = {}
+        self.output_paths = {}
+        self.waiting = {}
+        self.finished = {}
+        self.ready = deque()
+        self.hashed = 0
+        self.encodes_avoided = 0
+        self.seconds_saved = 0.0
+    
+    def jobs(self, jobs):
+        for job in jobs:
+            if job is None:
+                yield None
+                continue
+            input_path, output_path = job
+            representative = self._find_representative(input_path)
+            if representative is None:
+                self.output_paths[input_path] = output_path
+                yield input_path, output_path
+            elif representative in self.finished:
+                self.ready.append(self._materialize(self.finished[representative], input_path, output_path))
+            else:
+                self.waiting.setdefault(representative, []).append((input_path, output_path))
+    
+    def results(self, results):
+        for result in results:
+            yield result
+            if result.input_path in self.output_paths:
+                self.finished[result.input_path] = result
+            for input_path, output_path in self.waiting.pop(result.input_path, ()):
+                self.ready.append(self._materialize(result, input_path, output_path))
+            while self.ready:
+                yield self.ready.popleft()
+        
+        while self.ready:
+            yield self.ready.popleft()
+    
+    def _find_representative(self, input_path):
+        try:
+            size = os.path.getsize(input_path)
+        except OSError:
+            return None
+        
+        first = self.by_size.setdefault(size, input_path)
+        if first == input_path:
+            return None
+        # Only files that share a size with an earlier one are ever hashed; the
+        # first of that size is hashed then too, the first time a match is possible.
+        if first is not None:
+            first_digest = self._digest(first)
+            if first_digest is not None:
+                self.by_digest.setdefault((size, first_digest), first)
+            self.by_size[size] = None
+        
+        digest = self._digest(input_path)
+        if digest is None:
+            return None
+        representative = self.by_digest.setdefault((size, digest), input_path)
+        return None if representative == input_path else representative
+    
+    def _digest(self, path):
+        if path not in self.digests:
+            digest = hashlib.blake2b(digest_size=16)
+            try:
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(self.HASH_BLOCK_SIZE), b''):
+                        digest.update(block)
+                self.digests[path] = digest.digest()
+            except OSError:
+                self.digests[path] = None
+            self.hashed += 1
+        return self.digests[path]
+    
+    def _materialize(self, representative, input_path, output_path):
+        start = time.perf_counter()
+        if not representative.success:
+            # Identical bytes fail identically, so the error is reported, not retried.
+            return JobResult(input_path, output_path, False, representative.original_size,
+                             elapsed=time.perf_counter() - start, error=representative.error)
+        
+        base_path = self.output_paths[representative.input_path]
+        sources = [path for path, _ in representative.outputs] or [representative.output_path]
+        outputs = []
+        try:
+            for source in sources:
+                target = self._output_for(base_path, source, output_path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                self._link_or_copy(source, target)
+                outputs.append((target, os.path.getsize(target)))
+        except OSError as e:
+            return JobResult(input_path, output_path, False, representative.original_size,
+                             elapsed=time.perf_counter() - start, error=str(e))
+        
+        self.encodes_avoided += 1
+        self.seconds_saved += representative.elapsed
+        return JobResult(
+            input_path, outputs[0][0], True, representative.original_size, representative.new_size,
+            time.perf_counter() - start, quality=representative.quality, action='duplicate',
+            outputs=outputs if representative.outputs else None
+        )
+    
+    def _output_for(self, base_path, source, output_path):
+        # Variants and auto format derive their paths from the job's output path
+        # (subfolder, suffix, extension); the same change is applied to the copy's.
+        relative = os.path.relpath(source, os.path.dirname(base_path))
+        base_stem = os.path.splitext(os.path.basename(base_path))[0]
+        directory, filename = os.path.split(relative)
+        stem = os.path.splitext(os.path.basename(output_path))[0]
+        return os.path.join(os.path.dirname(output_path), directory, stem + filename[len(base_stem):])
+    
+    def _link_or_copy(self, source, target):
+        tmp_path = temp_path_for(target)
+        try:
+            if self.mode == 'link':
+                try:
+                    os.link(source, tmp_path)
+                    os.replace(tmp_path, target)
+                    return
+                except OSError:
+                    pass
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,533 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from pipeline import IOPipeline
+from processor import DEFAULT_MIN_PSNR, ImageProcessor, OutputVariant, sniff_extension
+from utils import FileOperations
+
+
+class JobResult:
+    
+    def __init__(self, input_path, output_path, success, original_size=0, new_size=0,
+                 elapsed=0.0, error=None, cached=False, quality=None, trials=0, action=None,
+                 outputs=None, timings=None):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.success = success
+        self.original_size = original_size
+        self.new_size = new_size
+        self.elapsed = elapsed
+        self.error = error
+        self.cached = cached
+        self.quality = quality
+        self.trials = trials
+        self.action = action
+        self.outputs = outputs or []
+        self.timings = timings
+        self.cache_key = None
+    
+    @property
+    def filename(self):
+        return os.path.basename(self.input_path)
+    
+    @property
+    def reduction(self):
+        if not self.original_size:
+            return 0.0
+        return ((self.original_size - self.new_size) / self.original_size) * 100
+
+
+# Settings that change the bytes written, and so belong in the result cache key.
+CACHE_KEY_SETTINGS = (
+    'compress', 'quality', 'target_bytes', 'target_percent',
+    'max_width', 'max_height', 'max_megapixels', 'png_effort',
+)
+
+_processor = None
+_settings = None
+_cache = None
+_pipeline = None
+_EXHAUSTED = object()
+
+
+def _create_processor(settings, writer=None):
+    return ImageProcessor(
+        hardlink_unchanged=settings['hardlink_unchanged'],
+        max_width=settings['max_width'],
+        max_height=settings['max_height'],
+        max_megapixels=settings['max_megapixels'],
+        instrument=settings['instrument'],
+        writer=writer,
+        trial_threads=settings['trial_threads'],
+        png_effort=settings['png_effort']
+    )
+
+
+def _init_worker(settings, cache_config=None):
+    global _processor, _settings, _cache, _pipeline
+    _shutdown_worker()
+    
+    if settings['io_threads']:
+        _pipeline = IOPipeline(read_threads=settings['io_threads'])
+    _processor = _create_processor(settings, _pipeline.writer if _pipeline else None)
+    _settings = dict(settings)
+    _settings['variants'] = [OutputVariant(**variant) for variant in settings['variants']]
+    
+    if cache_config:
+        from cache import ResultCache
+        _cache = ResultCache(**cache_config)
+
+
+def _shutdown_worker():
+    global _cache, _pipeline
+    if _processor is not None:
+        _processor.close()
+    if _pipeline is not None:
+        _pipeline.close()
+        _pipeline = None
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+
+
+def _process_job(job, source=None):
+    return _run_job(job, source, _processor, _settings, _cache)
+
+
+def _run_job(job, source, processor, settings, cache):
+    input_path, output_path = job
+    start = time.perf_counter()
+    try:
+        cache_key = None
+        # Variants and auto format decide their own output paths, so they bypass the cache.
+        if cache is not None and not settings['variants'] and not settings['auto_format']:
+            cache_key = cache.make_key(
+                input_path, output_path, {key: settings[key] for key in CACHE_KEY_SETTINGS}
+            )
+            if cache.fetch(cache_key, output_path):
+                return JobResult(
+                    input_path, output_path, True,
+                    os.path.getsize(input_path), os.path.getsize(output_path),
+                    time.perf_counter() - start, cached=True, action='cached',
+                    timings={'cache': time.perf_counter() - start} if settings['instrument'] else None
+                )
+        
+        quality, trials, outputs = None, 0, None
+        if settings['variants']:
+            success = processor.process_variants(
+                input_path, output_path, settings['variants'],
+                settings['quality'] if settings['compress'] else None, source=source
+            )
+            if success:
+                outputs = list(processor.last_outputs)
+        elif settings['target_bytes'] or settings['target_percent']:
+            success = processor.compress_to_target_size(
+                input_path, output_path, settings['target_bytes'], settings['target_percent'],
+                source=source
+            )
+            if success and processor.last_search:
+                quality = processor.last_search['quality']
+                trials = processor.last_search['trials']
+        elif settings['auto_format']:
+            success = processor.compress_to_best_format(
+                input_path, output_path, settings['quality'] if settings['compress'] else None,
+                settings['min_psnr'], source=source
+            )
+            if success:
+                outputs = list(processor.last_outputs)
+                output_path = outputs[0][0]
+                trials = processor.last_search['trials']
+        elif settings['compress']:
+            success = processor.compress_with_quality_reduction(
+                input_path, output_path, settings['quality'], source=source
+            )
+        else:
+            success = processor.optimize_without_quality_loss(input_path, output_path, source=source)
+        
+        result = JobResult(
+            input_path, output_path, success,
+            len(source) if source is not None else os.path.getsize(input_path),
+            processor.last_output_size if success else 0,
+            time.perf_counter() - start, quality=quality, trials=trials,
+            action=processor.last_action if success else None,
+            error=None if success else processor.last_error,
+            outputs=outputs, timings=processor.timer.timings
+        )
+        result.cache_key = cache_key if success else None
+        return result
+    except Exception as e:
+        return JobResult(
+            input_path, output_path, False,
+            elapsed=time.perf_counter() - start, error=str(e)
+        )
+
+
+def _process_chunk(chunk):
+    if _pipeline is not None:
+        return list(_stream(chunk))
+    return [_finish(_process_job(job)) for job in chunk]
+
+
+def _stream(jobs, cancelled=None):
+    # Sources are read up to a window ahead and each result is released once its own
+    # writes have landed, so reads and writes keep overlapping across chunk boundaries.
+    # An idle marker from the job source first drains everything in flight.
+    jobs = iter(jobs)
+    writer = _pipeline.writer
+    window = _settings['io_threads'] * 2
+    reads = deque()
+    waiting = deque()
+    exhausted = idle = False
+    while True:
+        if cancelled is not None and cancelled.is_set():
+            # Prefetched files have not started, so they are dropped like unread ones.
+            reads.clear()
+            exhausted = True
+        while not (exhausted or idle) and len(reads) < window:
+            job = next(jobs, _EXHAUSTED)
+            if job is _EXHAUSTED:
+                exhausted = True
+            elif job is None:
+                idle = True
+            else:
+                reads.append((job, _pipeline.prefetch(job[0])))
+        
+        if reads:
+            job, read = reads.popleft()
+            waiting.append((_run_prefetched(job, read), writer.submitted))
+            while waiting and waiting[0][1] <= writer.completed:
+                yield _settle(waiting.popleft()[0])
+            continue
+        
+        writer.flush()
+        while waiting:
+            yield _settle(waiting.popleft()[0])
+        if exhausted:
+            return
+        idle = False
+
+
+def _run_prefetched(job, read):
+    start = time.perf_counter()
+    try:
+        source = read.result()
+    except OSError as e:
+        return JobResult(job[0], job[1], False, error=str(e))
+    waited = time.perf_counter() - start
+    
+    result = _process_job(job, source)
+    if result.timings is not None:
+        result.timings['read'] = waited
+    return result
+
+
+def _settle(result):
+    paths = [path for path, _ in result.outputs] or [result.output_path]
+    errors, durations = _pipeline.writer.collect(paths)
+    if errors:
+        result.success, result.new_size, result.error = False, 0, errors[0]
+    if durations and result.timings is not None:
+        result.timings['write'] = sum(durations)
+    return _finish(result)
+
+
+def _finish(result):
+    # Only called once the outputs are on disk, so the cache copies complete files.
+    if result.cache_key and result.success:
+        # The output is already written, so a cache that cannot take it only costs a
+        # later re-encode.
+        try:
+            _cache.store(result.cache_key, result.output_path)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error caching {result.input_path}: {e}")
+    result.cache_key = None
+    return result
+
+
+def _indexed(jobs):
+    # Numbers jobs in submission order for ordered output; idle markers pass through.
+    index = 0
+    for job in jobs:
+        if job is None:
+            yield None
+            continue
+        yield index, (str(job[0]), str(job[1]))
+        index += 1
+
+
+class BatchEngine:
+    
+    def __init__(self, compress=False, quality=85, workers=None, chunksize=4, ordered=False,
+                 cache_dir=None, cache_max_bytes=1024 * 1024 * 1024,
+                 target_bytes=None, target_percent=None, hardlink_unchanged=False,
+                 max_width=None, max_height=None, max_megapixels=None, variants=None,
+                 memory_budget=None, metrics=None, io_threads=4, auto_format=False,
+                 min_psnr=DEFAULT_MIN_PSNR, png_effort='default', dedup=None):
+        self.settings = {
+            'compress': compress,
+            'quality': quality,
+            'target_bytes': target_bytes,
+            'target_percent': target_percent,
+            'hardlink_unchanged': hardlink_unchanged,
+            'max_width': max_width,
+            'max_height': max_height,
+            'max_megapixels': max_megapixels,
+            'variants': [variant.to_dict() for variant in variants or ()],
+            'instrument': metrics is not None,
+            'io_threads': io_threads,
+            'auto_format': auto_format,
+            'min_psnr': min_psnr,
+            'png_effort': png_effort,
+        }
+        self.cache_config = None
+        if cache_dir:
+            self.cache_config = {'cache_dir': cache_dir, 'max_bytes': cache_max_bytes}
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        # Trial encodes only get the cores the pool leaves idle.
+        self.settings['trial_threads'] = max(1, (os.cpu_count() or 1) // self.workers)
+        self.chunksize = max(1, chunksize)
+        self.ordered = ordered
+        self.max_in_flight = self.workers * 2
+        self.memory_budget = memory_budget
+        self.metrics = metrics
+        # 'link' or 'copy': byte-identical sources are encoded once and the others
+        # get links or copies of that output.
+        self.dedup = dedup
+        self.deduplicator = None
+        self.cancelled = threading.Event()
+        self._cancel_future = None
+        self._local = threading.local()
+    
+    def process_bytes(self, data, filename=None):
+        # In-memory counterpart of run() for one image: the source is read from the
+        # buffer and the output handed back, so nothing touches the disk. Safe to
+        # call from several threads; each keeps its own processor.
+        if self.settings['variants']:
+            raise ValueError("process_bytes returns a single image and cannot write variants")
+        if hasattr(data, 'read'):
+            data = data.read()
+        data = bytes(data)
+        filename = os.path.basename(filename) if filename else f"image{sniff_extension(data)}"
+        
+        local = self._local
+        if not hasattr(local, 'processor'):
+            # Links need a source file on disk, so buffers always copy unchanged bytes.
+            settings = dict(self.settings, hardlink_unchanged=False)
+            local.outputs = {}
+            local.processor = _create_processor(settings, writer=local.outputs.__setitem__)
+            local.settings = settings
+        local.outputs.clear()
+        
+        stem, extension = os.path.splitext(filename)
+        output_name = stem + FileOperations.OUTPUT_EXTENSIONS.get(extension.lower(), extension)
+        job = (filename, os.path.join('output', output_name))
+        result = _run_job(job, data, local.processor, local.settings, None)
+        if not result.success:
+            return None, result
+        return local.outputs.pop(result.output_path), result
+    
+    def output_settings(self):
+        # Everything that decides what gets written, for comparing runs against each other.
+        return {key: self.settings[key] for key in CACHE_KEY_SETTINGS + ('variants', 'auto_format', 'min_psnr')}
+    
+    def cancel(self):
+        # Safe to call from any thread; the batch stops at the next completed chunk
+        # boundary and work that has not started is dropped.
+        self.cancelled.set()
+        future = self._cancel_future
+        if future is not None and not future.done():
+            future.set_result(None)
+    
+    def run(self, jobs):
+        # A job source may yield None when it has nothing ready yet; whatever is in
+        # flight is then finished and reported before the source is asked again.
+        self.cancelled.clear()
+        self.deduplicator = None
+        if self.dedup:
+            from dedup import Deduplicator
+            
+            self.deduplicator = Deduplicator(self.dedup)
+            jobs = self.deduplicator.jobs(jobs)
+        
+        if self.workers == 1:
+            results = self._run_serial(jobs)
+        else:
+            results = self._run_parallel(jobs)
+        if self.deduplicator is not None:
+            results = self.deduplicator.results(results)
+        
+        if self.metrics is None:
+            return results
+        return self._record(results)
+    
+    def _record(self, results):
+        for result in results:
+            self.metrics.record(result)
+            yield result
+    
+    def _run_serial(self, jobs):
+        _init_worker(self.settings, self.cache_config)
+        jobs = (None if job is None else (str(job[0]), str(job[1])) for job in jobs)
+        try:
+            if _pipeline is not None:
+                yield from _stream(jobs, self.cancelled)
+                return
+            while not self.cancelled.is_set():
+                chunk = self._take_chunk(jobs)
+                if chunk is None:
+                    break
+                if chunk:
+                    yield from _process_chunk(chunk)
+        finally:
+            _shutdown_worker()
+    
+    def _run_parallel(self, jobs):
+        # Imported here so serial and headless callers never pay for multiprocessing.
+        from concurrent.futures import FIRST_COMPLETED, Future, wait
+        from concurrent.futures.process import BrokenProcessPool
+        
+        indexed_jobs = _indexed(jobs)
+        retry_queue = deque()
+        in_flight = {}
+        buffered = {}
+        next_index = 0
+        held = None
+        estimates = {}
+        memory_in_use = 0
+        estimator = _create_processor(self.settings) if self.memory_budget else None
+        executor = self._create_executor()
+        # Waited on alongside the chunks, so cancel() wakes the loop without polling.
+        self._cancel_future = cancel_future = Future()
+        if self.cancelled.is_set():
+            cancel_future.set_result(None)
+        
+        try:
+            while not cancel_future.done():
+                idle = False
+                while len(in_flight) < self.max_in_flight:
+                    # A job retried after a crash runs alone, so if the pool breaks again
+                    # the culprit is known and nothing running beside it is lost.
+                    if any(retried for _, retried, _ in in_flight.values()):
+                        break
+                    if held:
+                        chunk, retried = held
+                        held = None
+                    elif retry_queue:
+                        if in_flight:
+                            break
+                        chunk, retried = retry_queue.popleft()
+                    else:
+                        chunk = self._take_chunk(indexed_jobs)
+                        if not chunk:
+                            idle = chunk is not None
+                            break
+                        retried = False
+                        if estimator is not None:
+                            for index, job in chunk:
+                                estimates[index] = self._estimate_memory(estimator, job)
+                    
+                    # A chunk's sources are all prefetched up front and held until it finishes,
+                    # on top of the largest image's own peak.
+                    costs = [estimates.get(index, (0, 0)) for index, _ in chunk]
+                    memory = max(peak - size for peak, size in costs) + sum(size for _, size in costs)
+                    # Images bigger than the whole budget still run, but only on their own.
+                    if estimator is not None and in_flight and memory_in_use + memory > self.memory_budget:
+                        held = (chunk, retried)
+                        break
+                    
+                    future = executor.submit(_process_chunk, [job for _, job in chunk])
+                    in_flight[future] = (chunk, retried, memory)
+                    memory_in_use += memory
+                
+                if not in_flight:
+                    if idle:
+                        continue
+                    break
+                
+                done, _ = wait([cancel_future, *in_flight], return_when=FIRST_COMPLETED)
+                done.discard(cancel_future)
+                completed = []
+                broken = False
+                
+                for future in done:
+                    chunk, retried, memory = in_flight.pop(future)
+                    memory_in_use -= memory
+                    try:
+                        completed.extend(zip((index for index, _ in chunk), future.result()))
+                    except BrokenProcessPool:
+                        broken = True
+                        completed.extend(self._requeue(chunk, retried, retry_queue))
+                    except Exception as e:
+                        completed.extend(
+                            (index, JobResult(job[0], job[1], False, error=str(e)))
+                            for index, job in chunk
+                        )
+                
+                if broken:
+                    # Every chunk still in flight died with the pool, not just the culprit.
+                    for chunk, retried, _ in in_flight.values():
+                        completed.extend(self._requeue(chunk, retried, retry_queue))
+                    in_flight.clear()
+                    memory_in_use = 0
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = self._create_executor()
+                
+                for index, _ in completed:
+                    estimates.pop(index, None)
+                
+                if not self.ordered:
+                    for _, result in completed:
+                        yield result
+                    continue
+                
+                buffered.update(completed)
+                while next_index in buffered:
+                    yield buffered.pop(next_index)
+                    next_index += 1
+        finally:
+            self._cancel_future = None
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _take_chunk(self, jobs):
+        # Up to chunksize jobs, cut short when the source has nothing more ready;
+        # None once it is exhausted.
+        chunk = []
+        for job in jobs:
+            if job is None:
+                return chunk
+            chunk.append(job)
+            if len(chunk) >= self.chunksize:
+                return chunk
+        return chunk or None
+    
+    def _estimate_memory(self, estimator, job):
+        # (peak, source size): the peak already counts the image's own source bytes.
+        try:
+            return estimator.estimate_peak_memory(*job), os.path.getsize(job[0])
+        except Exception:
+            # Unreadable headers fail fast in the worker; they need no reservation.
+            return 0, 0
+    
+    def _create_executor(self):
+        from concurrent.futures import ProcessPoolExecutor
+        
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.settings, self.cache_config)
+        )
+    
+    def _requeue(self, chunk, retried, retry_queue):
+        # Retried jobs only ever run alone, so a retried job that died is the culprit.
+        if retried:
+            return [
+                (index, JobResult(job[0], job[1], False, error="Worker process terminated"))
+                for index, job in chunk
+            ]
+        # Retry each job on its own so a single crashing image cannot take others with it.
+        for item in chunk:
+            retry_queue.append(([item], True))
+        return []
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+from PIL import Image
+
+from processor import ImageProcessor
+from utils import FileOperations
+
+
+class SavingsEstimator:
+    
+    PROXY_SIZE = 512
+    
+    def __init__(self, input_folder, output_folder=None, sample_size=24, recursive=True, include=None,
+                 exclude=None, workers=None, file_ops=None):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.sample_size = sample_size
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.file_ops = file_ops or FileOperations()
+        self.processor = ImageProcessor()
+        self.files = 0
+        self.original_bytes = 0
+        # One entry per stratum: (files, bytes, sample path, sample size, preview or None).
+        self.strata = None
+        self.decode_seconds_per_pixel = 0.0
+        # A superseded estimate may still be finishing its current sample.
+        self.lock = threading.Lock()
+    
+    def prepare(self, cancelled=None):
+        # Scanning and decoding proxies is the slow part, so it happens once per
+        # folder; estimate() only re-encodes the cached proxies.
+        if self.strata is not None:
+            return True
+        
+        # Earlier outputs often sit inside the input folder, as the batch's own do.
+        skip_dirs = (self.output_folder,) if self.output_folder else ()
+        files = []
+        for path in self.file_ops.iter_image_files(self.input_folder, self.recursive, self.include,
+                                                   self.exclude, skip_dirs):
+            if cancelled is not None and cancelled.is_set():
+                return False
+            try:
+                files.append((os.path.getsize(path), path))
+            except OSError:
+                continue
+        files.sort()
+        
+        # Files sorted by size are cut into equal groups, and each is represented by
+        # its median file, so a few huge images cannot hide among many small ones.
+        count = min(self.sample_size, len(files))
+        strata = []
+        for index in range(count):
+            if cancelled is not None and cancelled.is_set():
+                return False
+            group = files[index * len(files) // count:(index + 1) * len(files) // count]
+            size, path = group[len(group) // 2]
+            output_path = self.file_ops.output_path_for(path, self.input_folder, self.input_folder)
+            try:
+                preview = self.processor.open_preview(path, output_path, self.PROXY_SIZE)
+            except Exception:
+                preview = None
+            strata.append((len(group), sum(file_size for file_size, _ in group), path, size, preview))
+        
+        if strata:
+            self.decode_seconds_per_pixel = self._time_full_decode(strata[len(strata) // 2])
+        self.files = len(files)
+        self.original_bytes = sum(size for size, _ in files)
+        self.strata = strata
+        return True
+    
+    def estimate(self, compress=False, quality=85, cancelled=None):
+        with self.lock:
+            return self._estimate(compress, quality, cancelled)
+    
+    def _estimate(self, compress, quality, cancelled):
+        if not self.prepare(cancelled):
+            return None
+        
+        output_bytes = 0.0
+        seconds = 0.0
+        for _, total_bytes, _, size, preview in self.strata:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            if preview is None:
+                # Unreadable files fail in the batch; they are counted as unchanged.
+                output_bytes += total_bytes
+                continue
+            
+            start = time.perf_counter()
+            data = self.processor.encode_preview(preview, quality if compress else None)
+            encode_seconds = time.perf_counter() - start
+            ratio = 1.0 if data is None else len(data) / preview['reference_bytes']
+            if preview['source_format'] == preview['output_format']:
+                ratio = min(ratio, 1.0)
+            output_bytes += total_bytes * ratio
+            
+            # Decoding and encoding scale with pixels; the stratum scales with bytes.
+            scale = preview['pixels'] / (preview['proxy'].size[0] * preview['proxy'].size[1])
+            file_seconds = self.decode_seconds_per_pixel * preview['pixels'] + encode_seconds * scale
+            seconds += file_seconds * total_bytes / max(size, 1)
+        
+        return {
+            'files': self.files,
+            'sampled': len(self.strata),
+            'original_bytes': self.original_bytes,
+            'output_bytes': int(output_bytes),
+            'saved_bytes': int(self.original_bytes - output_bytes),
+            'saved_percent': (1 - output_bytes / self.original_bytes) * 100 if self.original_bytes else 0.0,
+            'seconds': seconds / self.workers,
+        }
+    
+    def _time_full_decode(self, stratum):
+        # Proxies are decoded at reduced scale, so one full decode calibrates the rest.
+        _, _, path, _, preview = stratum
+        if preview is None:
+            return 0.0
+        start = time.perf_counter()
+        try:
+            with Image.open(path) as img:
+                img.load()
+        except Exception:
+            return 0.0
+        return (time.perf_counter() - start) / preview['pixels']
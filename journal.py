@@ -0,0 +1,135 @@
+import glob
+import json
+import os
+import time
+
+
+JOURNAL_NAME = ".image_size_reducer.journal"
+JOURNAL_VERSION = 1
+
+
+def journal_path(output_folder):
+    return os.path.join(output_folder, JOURNAL_NAME)
+
+
+def has_unfinished_run(output_folder):
+    path = journal_path(output_folder)
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb') as f:
+        # The completion marker is always the last record, so only the tail matters.
+        f.seek(max(0, os.path.getsize(path) - 4096))
+        last_line = f.read().rstrip(b'\n').rsplit(b'\n', 1)[-1]
+    try:
+        return 'complete' not in json.loads(last_line)
+    except ValueError:
+        return True
+
+
+class JobJournal:
+    
+    def __init__(self, output_folder, input_folder, settings, resume=False, sync_interval=1.0):
+        self.path = journal_path(output_folder)
+        self.input_folder = os.path.abspath(input_folder)
+        self.settings = settings
+        self.sync_interval = sync_interval
+        self.last_sync = time.monotonic()
+        self.queued = {}
+        self.finished = set()
+        self.scan_complete = False
+        self.resumed = 0
+        
+        needs_newline = False
+        if resume and os.path.exists(self.path):
+            needs_newline = self._load()
+            self.file = open(self.path, 'a', encoding='utf-8')
+            if needs_newline:
+                self.file.write('\n')
+        else:
+            self.file = open(self.path, 'w', encoding='utf-8')
+            self._write({'version': JOURNAL_VERSION, 'input': self.input_folder, 'settings': settings}, sync=True)
+    
+    def jobs(self, scan):
+        # Jobs that were in flight when the last run stopped go first; their outputs
+        # were written atomically, so at most a stray temp file is left to remove.
+        for input_path, output_path in list(self.queued.items()):
+            self._remove_temp_files(output_path)
+            yield input_path, output_path
+        
+        if self.scan_complete:
+            return
+        
+        for input_path, output_path in scan:
+            if input_path in self.queued or input_path in self.finished:
+                continue
+            self.queued[input_path] = output_path
+            self._write({'queued': input_path, 'output': output_path})
+            yield input_path, output_path
+        
+        self.scan_complete = True
+        self._write({'scanned': len(self.queued) + len(self.finished)}, sync=True)
+    
+    def record(self, result):
+        self.queued.pop(result.input_path, None)
+        self.finished.add(result.input_path)
+        if result.success:
+            self._write({'done': result.input_path, 'size': result.new_size})
+        else:
+            self._write({'failed': result.input_path, 'error': result.error})
+    
+    def close(self):
+        if self.scan_complete and not self.queued:
+            self._write({'complete': True})
+        self._sync()
+        self.file.close()
+    
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        
+        lines = data.split(b'\n')
+        header = json.loads(lines[0]) if lines[0] else {}
+        if (header.get('version') != JOURNAL_VERSION or header.get('input') != self.input_folder
+                or header.get('settings') != self.settings):
+            raise ValueError(
+                f"{self.path} belongs to a run with a different input folder or settings; "
+                "start a new run instead of resuming"
+            )
+        
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash can cut the final record short; everything before it is intact.
+                continue
+            if 'queued' in record:
+                self.queued[record['queued']] = record['output']
+            elif 'done' in record or 'failed' in record:
+                input_path = record.get('done', record.get('failed'))
+                self.queued.pop(input_path, None)
+                self.finished.add(input_path)
+            elif 'scanned' in record:
+                self.scan_complete = True
+        
+        self.resumed = len(self.finished)
+        return bool(data) and not data.endswith(b'\n')
+    
+    def _remove_temp_files(self, output_path):
+        directory, filename = os.path.split(output_path)
+        for path in glob.glob(os.path.join(glob.escape(directory), f".{glob.escape(filename)}.*.tmp")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def _write(self, record, sync=False):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        # Flushing hands each record to the OS, which survives the app crashing; the
+        # periodic fsync bounds what a power loss can cost to a second of redone work.
+        if sync or time.monotonic() - self.last_sync >= self.sync_interval:
+            self._sync()
+    
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
@@ -1,12 +1,19 @@
-import tkinter as tk
-from app import ImageSizeReducer
+import sys
 
 
 def main():
+    # Any command-line arguments select the headless runner, which never imports tkinter.
+    if len(sys.argv) > 1:
+        from cli import main as cli_main
+        return cli_main()
+    
+    import tkinter as tk
+    from app import ImageSizeReducer
+    
     root = tk.Tk()
     app = ImageSizeReducer(root)
     root.mainloop()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,179 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+
+SIZE_BUCKETS = (
+    (100 * 1024, '<100KB'),
+    (1024 * 1024, '100KB-1MB'),
+    (10 * 1024 * 1024, '1-10MB'),
+)
+
+_NULL_STAGE = nullcontext()
+
+
+def size_bucket(size):
+    for limit, label in SIZE_BUCKETS:
+        if size < limit:
+            return label
+    return '>=10MB'
+
+
+class _Stage:
+    
+    __slots__ = ('timings', 'name', 'start')
+    
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+    
+    def __exit__(self, *exc_info):
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class StageTimer:
+    
+    def __init__(self):
+        self.timings = {}
+    
+    def reset(self):
+        self.timings = {}
+    
+    def stage(self, name):
+        return _Stage(self.timings, name)
+
+
+class NullTimer:
+    
+    timings = None
+    
+    def reset(self):
+        pass
+    
+    def stage(self, name):
+        return _NULL_STAGE
+
+
+class Histogram:
+    
+    # Four buckets per doubling from 1 microsecond, so estimates are within ~19%.
+    BUCKETS_PER_OCTAVE = 4
+    MIN_VALUE = 1e-6
+    
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+    
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        bucket = int(math.log2(max(value, self.MIN_VALUE) / self.MIN_VALUE) * self.BUCKETS_PER_OCTAVE)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+    
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                upper = self.MIN_VALUE * 2 ** ((bucket + 1) / self.BUCKETS_PER_OCTAVE)
+                return min(upper, self.max)
+        return self.max
+    
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'p50': self.percentile(0.50),
+            'p90': self.percentile(0.90),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class MetricsAggregator:
+    
+    def __init__(self):
+        self.counters = {'succeeded': 0, 'failed': 0, 'unchanged': 0, 'cached': 0}
+        self.stages = {}
+    
+    def write(self, event):
+        if not event['success']:
+            self.counters['failed'] += 1
+        else:
+            self.counters['succeeded'] += 1
+            self.counters['unchanged'] += event['action'] in ('passthrough', 'skipped')
+            self.counters['cached'] += event['cached']
+        
+        for stage, seconds in event['stages'].items():
+            for key in ('all', f"format={event['format']}", f"size={event['size_bucket']}"):
+                self.stages.setdefault(stage, {}).setdefault(key, Histogram()).add(seconds)
+        self.stages.setdefault('total', {}).setdefault('all', Histogram()).add(event['elapsed'])
+    
+    def summary(self):
+        return {
+            'counters': dict(self.counters),
+            'stages': {
+                stage: {key: histogram.summary() for key, histogram in sorted(groups.items())}
+                for stage, groups in self.stages.items()
+            },
+        }
+    
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    
+    def __init__(self, path):
+        self.file = open(path, 'a', buffering=1024 * 1024)
+    
+    def write(self, event):
+        self.file.write(json.dumps(event) + '\n')
+    
+    def close(self):
+        self.file.close()
+
+
+class Metrics:
+    
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self.lock = threading.Lock()
+    
+    def record(self, result):
+        event = {
+            'file': result.input_path,
+            'format': os.path.splitext(result.input_path)[1].lower().lstrip('.') or 'unknown',
+            'size_bucket': size_bucket(result.original_size),
+            'success': result.success,
+            'action': result.action,
+            'cached': result.cached,
+            'original_size': result.original_size,
+            'new_size': result.new_size,
+            'elapsed': result.elapsed,
+            'stages': result.timings or {},
+            'error': result.error,
+        }
+        with self.lock:
+            for sink in self.sinks:
+                sink.write(event)
+    
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,93 @@
+import os
+import queue
+import threading
+import time
+
+
+def temp_path_for(path):
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def atomic_write(path, data):
+    # Readers only ever see the old file or the complete new one, never a partial write.
+    tmp_path = temp_path_for(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class AsyncWriter:
+    
+    def __init__(self, max_pending=8):
+        self.queue = queue.Queue(max_pending)
+        self.errors = {}
+        self.durations = {}
+        # Writes land in the order they were queued, so a caller that noted
+        # `submitted` knows its writes are done once `completed` catches up.
+        self.submitted = 0
+        self.completed = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def __call__(self, path, data):
+        # Blocks once max_pending writes are queued, so encoding cannot outrun the disk.
+        self.submitted += 1
+        self.queue.put((path, data))
+    
+    def collect(self, paths):
+        # Errors and durations of finished writes to these paths.
+        errors = [self.errors.pop(path) for path in paths if path in self.errors]
+        durations = [self.durations.pop(path) for path in paths if path in self.durations]
+        return errors, durations
+    
+    def flush(self):
+        self.queue.join()
+    
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, data = item
+                start = time.perf_counter()
+                atomic_write(path, data)
+                self.durations[path] = time.perf_counter() - start
+            except Exception as e:
+                self.errors[path] = str(e)
+            finally:
+                if item is not None:
+                    self.completed += 1
+                self.queue.task_done()
+
+
+class IOPipeline:
+    
+    def __init__(self, read_threads=4, max_pending_writes=8):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.readers = ThreadPoolExecutor(max_workers=read_threads, thread_name_prefix="prefetch")
+        self.writer = AsyncWriter(max_pending_writes)
+    
+    def prefetch(self, path):
+        return self.readers.submit(read_file, path)
+    
+    def close(self):
+        self.readers.shutdown(wait=True)
+        self.writer.close()
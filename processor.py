@@ -1,41 +1,909 @@
-from PIL import Image
+import io
+import math
+import os
+import shutil
+import time
+import zlib
+
+from PIL import Image, ImageChops, ImageStat, UnidentifiedImageError
+
+from metrics import NullTimer, StageTimer
+from pipeline import atomic_write, temp_path_for
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ioctl that asks copy-on-write filesystems (Btrfs, XFS) to share extents.
+FICLONE = 0x40049409
+
+# libjpeg's baseline luminance table, i.e. quality 50 before scaling.
+STANDARD_LUMINANCE_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+    'BMP': '.bmp',
+    'TIFF': '.tiff',
+}
+
+# Output extensions resolved without Image.registered_extensions(), which imports
+# every Pillow plugin on each run.
+EXTENSION_FORMATS = {
+    '.jpg': 'JPEG', '.jpeg': 'JPEG', '.jpe': 'JPEG', '.jfif': 'JPEG',
+    '.png': 'PNG',
+    '.webp': 'WEBP',
+    '.bmp': 'BMP',
+    '.tif': 'TIFF', '.tiff': 'TIFF',
+    '.gif': 'GIF',
+}
+
+BYTES_PER_PIXEL = {
+    '1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2,
+    'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3,
+    'RGBA': 4, 'RGBa': 4, 'CMYK': 4, 'I': 4, 'F': 4,
+}
+
+# Modes each encoder can write as-is; anything else is converted before encoding.
+OUTPUT_MODES = {
+    'JPEG': ('L', 'RGB'),
+    'PNG': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I;16'),
+    'WEBP': ('RGB', 'RGBA'),
+    'BMP': ('1', 'L', 'P', 'RGB'),
+    'TIFF': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I;16'),
+}
+
+# Modes with more than 8 bits per channel, which neither JPEG nor WebP can hold.
+DEEP_MODES = ('I', 'I;16', 'I;16B', 'I;16L', 'I;16N', 'F')
+
+# Modes Image.resize can filter properly; palette and bilevel images only get NEAREST.
+RESAMPLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'I', 'F')
+
+WHITE = (255, 255, 255)
+
+# Images with at most this many colours are treated as graphics and can be palettized losslessly.
+PALETTE_COLOURS = 256
+
+# libwebp refuses anything larger in either dimension.
+WEBP_MAX_DIMENSION = 16383
+
+# Lossless WebP effort. Higher efforts take 2-5x longer for well under 1% on both
+# photos and graphics.
+WEBP_LOSSLESS = {'lossless': True, 'quality': 25, 'method': 1}
+
+# zlib settings per PNG effort level. 'optimize' also makes Pillow pick the filter
+# per row; 'max' keeps the smallest result of several strategies.
+PNG_EFFORT = {
+    'fast': ({'compress_level': 1, 'compress_type': zlib.Z_RLE},),
+    'default': ({'optimize': True},),
+    'max': (
+        {'optimize': True},
+        {'optimize': True, 'compress_type': zlib.Z_FILTERED},
+        {'optimize': True, 'compress_type': zlib.Z_RLE},
+    ),
+}
+
+# Lossy auto-format candidates must reconstruct the image at least this well.
+DEFAULT_MIN_PSNR = 35.0
+
+# Lossless encodes of images with more than 256 colours practically never get below this.
+LOSSLESS_MIN_BITS_PER_PIXEL = 1.0
+
+
+def fit_within(size, max_width=None, max_height=None, max_megapixels=None):
+    width, height = size
+    scale = 1.0
+    if max_width:
+        scale = min(scale, max_width / width)
+    if max_height:
+        scale = min(scale, max_height / height)
+    if max_megapixels:
+        scale = min(scale, math.sqrt(max_megapixels * 1000000 / (width * height)))
+    
+    if scale >= 1:
+        return None
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def image_format(img):
+    # Pillow reports the multi-picture JPEGs phones write as MPO; the first picture
+    # decodes and encodes like any other JPEG.
+    return 'JPEG' if img.format == 'MPO' else img.format
+
+
+def sniff_extension(data, default='.jpg'):
+    # Only the header is parsed, to name an upload that arrived without a filename.
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return FORMAT_EXTENSIONS.get(image_format(img), default)
+    except Exception:
+        return default
+
+
+class OutputVariant:
+    
+    FIELDS = ('max_width', 'max_height', 'max_megapixels', 'format', 'quality', 'suffix', 'subfolder')
+    
+    def __init__(self, max_width=None, max_height=None, max_megapixels=None, format=None,
+                 quality=None, suffix='', subfolder=''):
+        self.max_width = max_width
+        self.max_height = max_height
+        self.max_megapixels = max_megapixels
+        self.format = format.upper() if format else None
+        self.quality = quality
+        self.suffix = suffix
+        self.subfolder = subfolder
+    
+    @classmethod
+    def parse(cls, spec):
+        # "max_width=800,format=webp,quality=80,suffix=_800"
+        values = {}
+        for item in filter(None, spec.split(',')):
+            key, _, value = item.partition('=')
+            key = key.strip()
+            if key not in cls.FIELDS:
+                raise ValueError(f"Unknown variant setting: {key}")
+            if key in ('max_width', 'max_height', 'quality'):
+                value = int(value)
+            elif key == 'max_megapixels':
+                value = float(value)
+            values[key] = value.strip() if isinstance(value, str) else value
+        return cls(**values)
+    
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+    
+    def output_path(self, output_path):
+        directory, filename = os.path.split(output_path)
+        stem, extension = os.path.splitext(filename)
+        if self.format:
+            extension = FORMAT_EXTENSIONS.get(self.format, extension)
+        return os.path.join(directory, self.subfolder, f"{stem}{self.suffix}{extension}")
 
 
 class ImageProcessor:
     
-    def optimize_without_quality_loss(self, input_path, output_path):
+    MIN_QUALITY = 10
+    MAX_QUALITY = 95
+    QUALITY_FORMATS = {'JPEG', 'WEBP'}
+    
+    def __init__(self, hardlink_unchanged=False, max_width=None, max_height=None, max_megapixels=None,
+                 instrument=False, writer=None, trial_threads=1, png_effort='default'):
+        self.hardlink_unchanged = hardlink_unchanged
+        self.png_effort = png_effort
+        self.writer = writer
+        self.trial_threads = trial_threads
+        self._trial_pool = None
+        self.max_width = max_width
+        self.max_height = max_height
+        self.max_megapixels = max_megapixels
+        self.recent_qualities = []
+        self.last_search = None
+        self.last_action = None
+        self.last_outputs = []
+        self.last_error = None
+        self.last_output_size = 0
+        self._source = None
+        self.timer = StageTimer() if instrument else NullTimer()
+    
+    def optimize_without_quality_loss(self, input_path, output_path, source=None):
+        self._begin(source)
         try:
-            with Image.open(input_path) as img:
-                img = self._convert_to_rgb(img)
+            output_format = self._output_format(output_path)
+            with self._open(input_path) as img:
+                target_size = self._limited_size(img.size)
+                if target_size is None and self._is_quality_reduction_pointless(img, output_format, 95):
+                    return self._keep_original(input_path, output_path, 'skipped')
                 
-                if input_path.lower().endswith(('.png', '.bmp')):
-                    img.save(output_path, optimize=True)
-                else:
-                    img.save(output_path, quality=95, optimize=True, progressive=True)
-                    
-            return True
+                source_format = image_format(img)
+                img = self._prepare(img, target_size, output_format)
+                data = self._encode_without_quality_loss(img, output_format, input_path)
+            
+            return self._write_if_smaller(
+                input_path, output_path, data,
+                source_format == output_format and target_size is None
+            )
         except Exception as e:
+            self.last_error = str(e)
             print(f"Error optimizing {input_path}: {e}")
             return False
     
-    def compress_with_quality_reduction(self, input_path, output_path, quality):
+    def compress_with_quality_reduction(self, input_path, output_path, quality, source=None):
+        self._begin(source)
         try:
-            with Image.open(input_path) as img:
-                img = self._convert_to_rgb(img)
-                img.save(output_path, quality=quality, optimize=True, progressive=True)
+            output_format = self._output_format(output_path)
+            with self._open(input_path) as img:
+                target_size = self._limited_size(img.size)
+                if target_size is None and self._is_quality_reduction_pointless(img, output_format, quality):
+                    return self._keep_original(input_path, output_path, 'skipped')
                 
-            return True
+                source_format = image_format(img)
+                img = self._prepare(img, target_size, output_format)
+                data = self._encode_at_quality(img, output_format, quality)
+            
+            return self._write_if_smaller(
+                input_path, output_path, data,
+                source_format == output_format and target_size is None
+            )
         except Exception as e:
+            self.last_error = str(e)
             print(f"Error compressing {input_path}: {e}")
             return False
     
-    def _convert_to_rgb(self, img):
-        if img.mode in ('RGBA', 'LA', 'P'):
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            return background
-        elif img.mode != 'RGB':
-            return img.convert('RGB')
+    def compress_to_target_size(self, input_path, output_path, target_bytes=None, target_percent=None,
+                                source=None):
+        self._begin(source)
+        try:
+            start = time.perf_counter()
+            original_size = self._source_size(input_path)
+            if target_bytes is None:
+                target_bytes = original_size * target_percent / 100
+            
+            output_format = self._output_format(output_path)
+            with self._open(input_path) as img:
+                target_size = self._limited_size(img.size)
+                same_format = image_format(img) == output_format and target_size is None
+                if original_size <= target_bytes and same_format:
+                    self.last_search = None
+                    return self._keep_original(input_path, output_path, 'skipped')
+                
+                img = self._prepare(img, target_size, output_format)
+            
+            if output_format in self.QUALITY_FORMATS:
+                quality, data, trials = self._search_quality(img, output_format, target_bytes)
+                self.recent_qualities = (self.recent_qualities + [quality])[-8:]
+            else:
+                quality, trials = None, 1
+                data = self._encode_lossless(img, output_format)
+            
+            # A target the encode cannot get under still must not grow the file.
+            if not self._write_if_smaller(input_path, output_path, data, same_format):
+                return False
+            output_size = len(data)
+            if self.last_action == 'passthrough':
+                quality, output_size = None, original_size
+            self.last_search = {
+                'quality': quality,
+                'trials': trials,
+                'target_bytes': int(target_bytes),
+                'met_target': output_size <= target_bytes,
+                'seconds': time.perf_counter() - start,
+            }
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"Error compressing {input_path} to target size: {e}")
+            return False
+    
+    def process_variants(self, input_path, output_path, variants, quality=85, source=None):
+        # quality=None encodes variants without quality loss, as in optimize mode.
+        self._begin(source)
+        try:
+            default_format = self._output_format(output_path)
+            with self._open(input_path) as img:
+                source_format, source_size = image_format(img), img.size
+                sizes = [self._variant_size(img.size, variant) for variant in variants]
+                largest = max(sizes, key=lambda size: size[0] * size[1])
+                img = self._prepare(img, largest if largest != img.size else None)
+                if any(size != img.size for size in sizes):
+                    img = self._resampleable(img)
+            
+            # Walk from the largest size down, resizing each level from the one before
+            # it so every resample works on the smallest image that still has the detail.
+            outputs = []
+            level = img
+            for size, variant in sorted(zip(sizes, variants), key=lambda item: -item[0][0] * item[0][1]):
+                if level.size != size:
+                    with self.timer.stage('resize'):
+                        level = level.resize(size, Image.LANCZOS)
+                
+                output_format = variant.format or default_format
+                with self.timer.stage('convert'):
+                    converted = self._convert_for_output(level, output_format)
+                if variant.quality or quality:
+                    data = self._encode_at_quality(converted, output_format, variant.quality or quality)
+                else:
+                    data = self._encode_without_quality_loss(converted, output_format, input_path)
+                variant_path = variant.output_path(output_path)
+                os.makedirs(os.path.dirname(variant_path) or '.', exist_ok=True)
+                
+                # A full-size variant in the source's format is never larger than the source.
+                same_format = output_format == source_format and size == source_size
+                if not self._write_if_smaller(input_path, variant_path, data, same_format):
+                    return False
+                outputs.append((variant_path, self._source_size(input_path)
+                                if self.last_action == 'passthrough' else len(data)))
+            
+            self.last_action = 'encoded'
+            self.last_outputs = outputs
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"Error creating variants of {input_path}: {e}")
+            return False
+    
+    def compress_to_best_format(self, input_path, output_path, quality=None, min_psnr=DEFAULT_MIN_PSNR,
+                                source=None):
+        # quality=None only tries lossless candidates.
+        self._begin(source)
+        try:
+            with self._open(input_path) as img:
+                target_size = self._limited_size(img.size)
+                source_format = image_format(img)
+                lossy_source = self._is_lossy_source(input_path, source_format)
+                img = self._prepare(img, target_size)
+            
+            # A resized image cannot fall back to the source, so any passing encode will do.
+            limit = self._source_size(input_path) if target_size is None else None
+            with self.timer.stage('classify'):
+                candidates, fallback, colours = self._format_candidates(img, quality, lossy_source, limit)
+            best, trials, tried = None, 0, []
+            for group in (candidates, fallback):
+                if not group:
+                    continue
+                with self.timer.stage('encode'):
+                    encoded = list(self._map_trials(
+                        lambda candidate: self._encode_candidate(img, colours, *candidate), group
+                    ))
+                trials += len(group)
+                tried = list(zip(encoded, group))
+                with self.timer.stage('verify'):
+                    best = self._best_candidate(img, tried, limit, min_psnr)
+                # Only a miss on the quality floor is worth a slower, larger encode.
+                if best is not None or limit is not None and min(map(len, encoded)) >= limit:
+                    break
+            
+            if best is None and limit is None and tried:
+                # A resized image has nothing to fall back on; the most faithful encode stands in.
+                data, (output_format, _, _) = max(tried, key=lambda item: len(item[0]))
+                best = output_format, data
+            if best is None and self._output_format(output_path) != source_format:
+                # The output was renamed for a format it cannot keep (BMP becomes .png),
+                # so the source's bytes would not match its extension.
+                output_format = self._output_format(output_path)
+                best = output_format, self._encode_lossless(self._convert_for_output(img, output_format),
+                                                            output_format)
+            
+            if best is None:
+                self.last_outputs = [(output_path, limit)]
+                self.last_search = {'format': source_format, 'trials': trials}
+                return self._keep_original(input_path, output_path, 'passthrough')
+            
+            output_format, data = best
+            best_path = os.path.splitext(output_path)[0] + FORMAT_EXTENSIONS[output_format]
+            self._write_output(best_path, data)
+            self.last_action = 'encoded'
+            self.last_outputs = [(best_path, len(data))]
+            self.last_search = {'format': output_format, 'trials': trials}
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"Error choosing a format for {input_path}: {e}")
+            return False
+    
+    def close(self):
+        if self._trial_pool is not None:
+            self._trial_pool.shutdown()
+            self._trial_pool = None
+    
+    def _format_candidates(self, img, quality, lossy_source=False, limit=None):
+        if img.mode in DEEP_MODES:
+            # Only PNG keeps every level; the PSNR check would compare against an
+            # already clipped 8-bit conversion, so other formats are never tried.
+            return [('PNG', False, None)], [], None
+        
+        # Cheap checks decide which encodes can win before any of them runs.
+        alpha = self._has_alpha(img) and self._resampleable(img).getextrema()[-1][0] < 255
+        colours = None
+        if img.mode in ('L', 'LA', 'RGB', 'RGBA'):
+            colours = img.getcolors(PALETTE_COLOURS)
+        graphics = colours is not None or img.mode in ('1', 'P')
+        
+        webp = max(img.size) <= WEBP_MAX_DIMENSION
+        # Lossless WebP is smaller than PNG for practically every truecolour image.
+        lossless = [('WEBP', False, WEBP_LOSSLESS) if webp else ('PNG', False, None)]
+        if lossy_source:
+            # Storing a JPEG's or lossy WebP's artefacts losslessly costs many times its size.
+            lossless = []
+        elif (not graphics and limit is not None
+                and limit * 8 < img.size[0] * img.size[1] * LOSSLESS_MIN_BITS_PER_PIXEL):
+            # The source is already smaller than any lossless encode of a photo could be.
+            lossless = []
+        
+        if graphics and not lossy_source:
+            # Graphics: a palette PNG or lossless WebP beats any lossy encode of flat colour.
+            candidates = [('PNG', False, None)]
+            if webp:
+                candidates += lossless
+            return candidates, [], colours
+        
+        if lossy_source and limit is None:
+            # A resized lossy source cannot fall back to the original either, so it
+            # gets encodes that add no visible loss where others get lossless ones.
+            lossless = self._lossy_candidates(alpha, webp, 95)
+        
+        if quality is None:
+            return lossless, [], None
+        # A lossless encode of a photo is slow and rarely smaller, so it only runs
+        # when every lossy candidate misses the quality floor.
+        return self._lossy_candidates(alpha, webp, quality), lossless, None
+    
+    def _lossy_candidates(self, alpha, webp, quality):
+        candidates = []
+        if not alpha:
+            candidates.append(('JPEG', True, {'quality': quality, 'optimize': True, 'progressive': True}))
+        if webp:
+            candidates.append(('WEBP', True, {'quality': quality, 'method': 4}))
+        return candidates
+    
+    def _is_lossy_source(self, input_path, source_format):
+        if source_format == 'JPEG':
+            return True
+        if source_format != 'WEBP':
+            return False
+        
+        # WebP holds either a lossy 'VP8 ' or a lossless 'VP8L' bitstream; walk the
+        # RIFF chunks until one of them turns up.
+        f = io.BytesIO(self._source) if self._source is not None else open(input_path, 'rb')
+        with f:
+            f.seek(12)
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                if header[:4] == b'VP8 ':
+                    return True
+                if header[:4] == b'VP8L':
+                    return False
+                size = int.from_bytes(header[4:], 'little')
+                f.seek(size + (size & 1), 1)
+    
+    def _best_candidate(self, img, encoded, limit, min_psnr):
+        for data, (output_format, lossy, _) in sorted(encoded, key=lambda item: len(item[0])):
+            if limit is not None and len(data) >= limit:
+                return None
+            if lossy and self._psnr(self._convert_for_output(img, output_format), data) < min_psnr:
+                continue
+            return output_format, data
+        return None
+    
+    def _map_trials(self, function, items):
+        if self.trial_threads <= 1 or len(items) <= 1:
+            return map(function, items)
+        if self._trial_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            
+            # Pillow's encoders release the GIL, so trial encodes really run side by side.
+            self._trial_pool = ThreadPoolExecutor(max_workers=self.trial_threads, thread_name_prefix="trial")
+        return self._trial_pool.map(function, items)
+    
+    def _encode_candidate(self, img, colours, output_format, lossy, params):
+        if output_format == 'PNG':
+            return self._lossless_bytes(img, output_format, colours)
+        return self._save(self._convert_for_output(img, output_format), output_format, **params)
+    
+    def _reduce_colours(self, img, colours=None):
+        # Lossless only: the result decodes to exactly the same pixels. A colour-key
+        # transparency would not survive the mode change, so those images are left alone.
+        if img.mode not in ('RGB', 'RGBA') or 'transparency' in img.info:
+            return img
+        if colours is None:
+            colours = img.getcolors(PALETTE_COLOURS)
+            if colours is None:
+                return img
+        
+        grey = all(colour[0] == colour[1] == colour[2] for _, colour in colours)
+        if img.mode == 'RGB':
+            if grey:
+                return img.convert('L')
+            # A palette holding exactly the image's colours maps every pixel onto itself.
+            palette = Image.new('P', (1, 1))
+            palette.putpalette([value for _, colour in colours for value in colour])
+            return img.quantize(palette=palette, dither=Image.Dither.NONE)
+        
+        # quantize() cannot take a fixed palette with alpha, so check that the octree
+        # kept every colour before trusting it.
+        reduced = img.quantize(len(colours), method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+        if ImageChops.difference(reduced.convert('RGBA'), img).getbbox() is None:
+            return reduced
+        return img.convert('LA') if grey else img
+    
+    def _psnr(self, reference, data):
+        with Image.open(io.BytesIO(data)) as decoded:
+            decoded = decoded.convert(reference.mode)
+        stat = ImageStat.Stat(ImageChops.difference(reference, decoded))
+        mse = sum(stat.sum2) / (len(stat.sum2) * reference.size[0] * reference.size[1])
+        if not mse:
+            return math.inf
+        return 10 * math.log10(255 * 255 / mse)
+    
+    def _variant_size(self, size, variant):
+        limited = fit_within(size, variant.max_width, variant.max_height, variant.max_megapixels)
+        base = self._limited_size(size) or size
+        if limited is None or limited[0] * limited[1] > base[0] * base[1]:
+            return base
+        return limited
+    
+    def estimate_peak_memory(self, input_path, output_path=None):
+        # Only the header is read; nothing is decoded.
+        with Image.open(input_path) as img:
+            size, mode, source_format = img.size, img.mode, image_format(img)
+        output_format = self._output_format(output_path) if output_path else 'JPEG'
+        
+        target_size = self._limited_size(size)
+        decoded_size = size
+        if target_size is not None and source_format == 'JPEG':
+            scale = 1
+            while scale < 8 and size[0] // (scale * 2) >= target_size[0] and size[1] // (scale * 2) >= target_size[1]:
+                scale *= 2
+            decoded_size = (-(-size[0] // scale), -(-size[1] // scale))
+        
+        pixels = decoded_size[0] * decoded_size[1]
+        peak = pixels * BYTES_PER_PIXEL.get(mode, 4)
+        if source_format == 'WEBP':
+            # WebP decodes through RGBA canvases before Pillow converts the frame.
+            peak += pixels * 12
+        elif source_format == 'JPEG':
+            # libjpeg's working buffers add about a byte per pixel while it decodes.
+            peak += pixels
+        
+        if target_size is not None:
+            if mode not in RESAMPLE_MODES:
+                peak += pixels * 4
+                mode = 'RGB'
+            pixels = target_size[0] * target_size[1]
+            peak += pixels * max(BYTES_PER_PIXEL.get(mode, 4), 3)
+        
+        # The conversion keeps its input alive while it writes a single RGB frame;
+        # palette flattening adds one palette-sized copy on top.
+        if mode not in OUTPUT_MODES.get(output_format, ('RGB',)):
+            peak += pixels * (4 if mode == 'P' else 3)
+            mode = 'RGB'
+        
+        if output_format == 'JPEG':
+            # Progressive and optimized encodes keep every DCT coefficient until the end.
+            peak += pixels * (2 if mode == 'L' else 3)
+        elif output_format == 'PNG' and mode in ('RGB', 'RGBA'):
+            # Colour reduction adds a palette copy; for RGBA also the round trip that verifies it.
+            peak += pixels * (9 if mode == 'RGBA' else 1)
+        elif output_format == 'WEBP':
+            # libwebp encodes from its own RGBA and YUV copies of the frame, and an
+            # alpha channel goes through its much hungrier lossless encoder.
+            peak += pixels * (30 if mode == 'RGBA' else 7)
+        
+        # The encode lands in a BytesIO and getvalue() copies it once more. Uncompressed
+        # formats fill it with a whole frame; the others get 1.5 bytes per pixel.
+        if output_format in ('TIFF', 'BMP'):
+            encoded = pixels * BYTES_PER_PIXEL.get(mode, 4)
+        else:
+            encoded = pixels * 3 // 2
+        # The source bytes are prefetched and held until the image is written.
+        return peak + encoded * 2 + os.path.getsize(input_path)
+    
+    def open_preview(self, input_path, output_path, max_side=512):
+        # A small stand-in for estimating savings. JPEGs are decoded at reduced scale,
+        # and the proxy is re-encoded the way the source was probably saved, so an
+        # estimate compares encodes of the same pixels rather than different sizes.
+        output_format = self._output_format(output_path)
+        with Image.open(input_path) as img:
+            source_format = image_format(img)
+            source_quality = self.estimate_jpeg_quality(img)
+            pixels = img.size[0] * img.size[1]
+            if source_format == 'JPEG':
+                img.draft(img.mode, (max_side, max_side))
+            img.load()
+            proxy = self._resampleable(img)
+            size = fit_within(proxy.size, max_side, max_side)
+            proxy = proxy.resize(size, Image.BILINEAR) if size else proxy.copy()
+        
+        if source_format == 'JPEG':
+            params = {'quality': source_quality or 75}
+        elif source_format == 'WEBP':
+            params = {'quality': 80}
+        else:
+            params = {}
+        reference = self._save(self._convert_for_output(proxy, source_format), source_format, **params)
+        return {
+            'proxy': proxy,
+            'pixels': pixels,
+            'source_format': source_format,
+            'source_quality': source_quality,
+            'output_format': output_format,
+            'reference_bytes': len(reference),
+        }
+    
+    def encode_preview(self, preview, quality=None):
+        # Encodes a proxy from open_preview() the way the batch would encode the full
+        # image; returns None where the batch would keep the source unchanged.
+        output_format = preview['output_format']
+        if (output_format == 'JPEG' and preview['source_quality'] is not None
+                and (quality or 95) >= preview['source_quality']):
+            return None
+        
+        img = self._convert_for_output(preview['proxy'], output_format)
+        if quality is not None:
+            return self._encode_at_quality(img, output_format, quality)
+        if preview['source_format'] in ('PNG', 'BMP') or output_format not in self.QUALITY_FORMATS:
+            return self._encode_lossless(img, output_format)
+        return self._encode(img, output_format, quality=95, optimize=True, progressive=True)
+    
+    def estimate_jpeg_quality(self, img):
+        tables = getattr(img, 'quantization', None)
+        if image_format(img) != 'JPEG' or not tables or 0 not in tables:
+            return None
+        
+        # Invert libjpeg's quality scaling using the luminance table.
+        scale = sum(tables[0]) * 100 / sum(STANDARD_LUMINANCE_TABLE)
+        quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+        return max(1, min(100, round(quality)))
+    
+    def _is_quality_reduction_pointless(self, img, output_format, quality):
+        if output_format != 'JPEG':
+            return False
+        source_quality = self.estimate_jpeg_quality(img)
+        return source_quality is not None and quality >= source_quality
+    
+    def _write_if_smaller(self, input_path, output_path, data, same_format):
+        # Only an output in the source's own format can be replaced by the source bytes.
+        if same_format and len(data) >= self._source_size(input_path):
+            return self._keep_original(input_path, output_path, 'passthrough')
+        
+        self._write_output(output_path, data)
+        self.last_action = 'encoded'
+        return True
+    
+    def _write_output(self, output_path, data):
+        self.last_output_size += len(data)
+        if self.writer is not None:
+            # Only queued here; the writer times the write itself.
+            self.writer(output_path, data)
+            return
+        with self.timer.stage('write'):
+            atomic_write(output_path, data)
+    
+    def _keep_original(self, input_path, output_path, action):
+        self.last_action = action
+        if os.path.abspath(input_path) == os.path.abspath(output_path):
+            self.last_output_size = self._source_size(input_path)
+            return True
+        
+        # Bytes already in memory are cheapest to hand to the writer, unless the
+        # caller asked for links, which need the source file itself.
+        if self._source is not None and not self.hardlink_unchanged:
+            self._write_output(output_path, self._source)
+            return True
+        
+        with self.timer.stage('write'):
+            self._copy_original(input_path, output_path)
+        self.last_output_size = self._source_size(input_path)
+        return True
+    
+    def _copy_original(self, input_path, output_path):
+        tmp_path = temp_path_for(output_path)
+        try:
+            if self.hardlink_unchanged:
+                try:
+                    os.link(input_path, tmp_path)
+                    os.replace(tmp_path, output_path)
+                    return
+                except OSError:
+                    pass
+            
+            if fcntl is not None:
+                try:
+                    with open(input_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    os.replace(tmp_path, output_path)
+                    return
+                except OSError:
+                    pass
+            
+            shutil.copyfile(input_path, tmp_path)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+    
+    def _search_quality(self, img, output_format, target_bytes):
+        encoded = {}
+        
+        def fits(quality):
+            if quality not in encoded:
+                encoded[quality] = self._encode(
+                    img, output_format, quality=quality, optimize=True, progressive=True
+                )
+            return len(encoded[quality]) <= target_bytes
+        
+        # Find the highest quality that fits: start where recent images in this
+        # batch landed, take one bracketing step, then bisect what is left.
+        low, high = self.MIN_QUALITY, self.MAX_QUALITY
+        guess = self._predict_quality()
+        
+        if fits(guess):
+            low = guess
+            probe = min(guess + 5, high)
+            if probe > guess:
+                if fits(probe):
+                    low = probe
+                else:
+                    high = probe - 1
+        else:
+            high = guess - 1
+            probe = max(guess - 5, low)
+            if probe <= high:
+                if fits(probe):
+                    low = probe
+                else:
+                    high = probe - 1
+        
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle - 1
+        
+        if not fits(low):
+            # Even the lowest quality is too large; ship the smallest encode we have.
+            low = min(encoded, key=lambda quality: len(encoded[quality]))
+        return low, encoded[low], len(encoded)
+    
+    def _predict_quality(self):
+        if not self.recent_qualities:
+            return 75
+        ordered = sorted(self.recent_qualities)
+        return ordered[len(ordered) // 2]
+    
+    def _begin(self, source=None):
+        self.timer.reset()
+        self.last_action = None
+        self.last_error = None
+        self.last_output_size = 0
+        self._source = source
+    
+    def _open(self, input_path):
+        with self.timer.stage('open'):
+            if self._source is None:
+                return Image.open(input_path)
+            try:
+                return Image.open(io.BytesIO(self._source))
+            except UnidentifiedImageError:
+                raise UnidentifiedImageError(f"cannot identify image file '{input_path}'") from None
+    
+    def _source_size(self, input_path):
+        if self._source is not None:
+            return len(self._source)
+        return os.path.getsize(input_path)
+    
+    def _encode(self, img, output_format, **params):
+        with self.timer.stage('encode'):
+            return self._save(img, output_format, **params)
+    
+    def _encode_without_quality_loss(self, img, output_format, input_path):
+        # Lossless sources stay lossless wherever the output format allows it; lossy
+        # ones are re-encoded at a quality that adds no visible loss.
+        if input_path.lower().endswith(('.png', '.bmp')) or output_format not in self.QUALITY_FORMATS:
+            return self._encode_lossless(img, output_format)
+        return self._encode(img, output_format, quality=95, optimize=True, progressive=True)
+    
+    def _encode_at_quality(self, img, output_format, quality):
+        if output_format not in self.QUALITY_FORMATS:
+            return self._encode_lossless(img, output_format)
+        return self._encode(img, output_format, quality=quality, optimize=True, progressive=True)
+    
+    def _encode_lossless(self, img, output_format):
+        with self.timer.stage('encode'):
+            return self._lossless_bytes(img, output_format)
+    
+    def _lossless_bytes(self, img, output_format, colours=None):
+        if output_format == 'JPEG':
+            # JPEG has no lossless mode; without a quality Pillow would use 75.
+            return self._save(img, 'JPEG', quality=95, optimize=True, progressive=True)
+        if output_format == 'WEBP':
+            return self._save(img, 'WEBP', **WEBP_LOSSLESS)
+        if output_format != 'PNG':
+            return self._save(img, output_format, optimize=True)
+        img = self._reduce_colours(img, colours)
+        return min((self._save(img, 'PNG', **params) for params in PNG_EFFORT[self.png_effort]), key=len)
+    
+    def _save(self, img, output_format, **params):
+        buffer = io.BytesIO()
+        img.save(buffer, format=output_format, **params)
+        return buffer.getvalue()
+    
+    def _output_format(self, output_path):
+        extension = os.path.splitext(output_path)[1].lower()
+        if extension in EXTENSION_FORMATS:
+            return EXTENSION_FORMATS[extension]
+        Image.init()
+        return Image.EXTENSION.get(extension, 'JPEG')
+    
+    def _limited_size(self, size):
+        return fit_within(size, self.max_width, self.max_height, self.max_megapixels)
+    
+    def _prepare(self, img, target_size=None, output_format=None):
+        if target_size is not None and image_format(img) == 'JPEG':
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale so the full bitmap never exists.
+            img.draft(img.mode, target_size)
+        
+        with self.timer.stage('decode'):
+            img.load()
+        
+        # Resize before converting so any flattening runs on the smaller frame.
+        if target_size is not None and img.size != target_size:
+            with self.timer.stage('resize'):
+                img = self._resampleable(img).resize(target_size, Image.LANCZOS)
+        
+        if output_format is not None:
+            with self.timer.stage('convert'):
+                img = self._convert_for_output(img, output_format)
+        return img
+    
+    def _resampleable(self, img):
+        if img.mode in RESAMPLE_MODES:
+            return img
+        return img.convert('RGBA' if self._has_alpha(img) else 'RGB')
+    
+    def _has_alpha(self, img):
+        return img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in img.info
+    
+    def _convert_for_output(self, img, output_format):
+        allowed = OUTPUT_MODES.get(output_format, ('RGB',))
+        
+        if img.mode == 'P' and 'transparency' in img.info:
+            if output_format == 'PNG':
+                return img
+            if 'RGBA' in allowed:
+                return img.convert('RGBA')
+            img = self._flatten_palette(img)
+            return img if 'P' in allowed else img.convert('RGB')
+        
+        if img.mode in allowed:
+            return img
+        
+        if img.mode in ('RGBA', 'LA'):
+            if 'RGBA' in allowed:
+                return img.convert('RGBA')
+            return self._flatten_alpha(img)
+        
+        if img.mode in ('PA', 'RGBa', 'La'):
+            return self._convert_for_output(img.convert('RGBA'), output_format)
+        
+        return img.convert('RGB')
+    
+    def _flatten_alpha(self, img):
+        # paste() reads the alpha band in place when given the image as its own mask,
+        # so the white canvas is the only full-size allocation.
+        background = Image.new('RGB', img.size, WHITE)
+        background.paste(img, mask=img)
+        return background
+    
+    def _flatten_palette(self, img):
+        # Blend each palette entry over white instead of expanding the pixels to RGBA.
+        img = img.copy()
+        transparency = img.info.pop('transparency')
+        palette = img.getpalette() or []
+        
+        if isinstance(transparency, int):
+            alphas = {transparency: 0}
+        else:
+            alphas = dict(enumerate(transparency))
+        
+        for index, alpha in alphas.items():
+            for offset in range(index * 3, min(index * 3 + 3, len(palette))):
+                palette[offset] = (palette[offset] * alpha + 255 * (255 - alpha) + 127) // 255
+        
+        img.putpalette(palette)
         return img
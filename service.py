@@ -0,0 +1,230 @@
+import argparse
+import json
+import mimetypes
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from engine import BatchEngine
+
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+# Query parameters a request may use to override the service defaults.
+REQUEST_OPTIONS = {
+    'mode': str,
+    'quality': int,
+    'target_kb': float,
+    'target_percent': float,
+    'max_width': int,
+    'max_height': int,
+    'auto_format': lambda value: value.lower() in ('1', 'true', 'yes'),
+}
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class CompressionService:
+    
+    def __init__(self, workers=None, max_queue=64, max_engines=32, mode='optimize', quality=85, **defaults):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        # Pillow releases the GIL while decoding, resampling and encoding, so a
+        # thread pool scales across cores without copying buffers between processes.
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="compress")
+        # Requests beyond the workers plus the queue are turned away instead of piling up.
+        self.admission = threading.BoundedSemaphore(self.workers + max_queue)
+        self.defaults = dict(defaults, mode=mode, quality=quality)
+        self.max_engines = max_engines
+        self.engines = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'succeeded': 0, 'failed': 0, 'rejected': 0,
+                      'bytes_in': 0, 'bytes_out': 0, 'busy_seconds': 0.0}
+    
+    def compress(self, data, filename=None, **options):
+        if not self.admission.acquire(blocking=False):
+            with self.lock:
+                self.stats['rejected'] += 1
+            raise ServiceBusy()
+        try:
+            engine = self._engine(options)
+            return self.executor.submit(engine.process_bytes, data, filename).result()
+        finally:
+            self.admission.release()
+    
+    def record(self, data, output, result):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_in'] += len(data)
+            self.stats['busy_seconds'] += result.elapsed
+            if output is None:
+                self.stats['failed'] += 1
+            else:
+                self.stats['succeeded'] += 1
+                self.stats['bytes_out'] += len(output)
+    
+    def close(self):
+        self.executor.shutdown()
+    
+    def _engine(self, options):
+        options = dict(self.defaults, **options)
+        key = tuple(sorted(options.items()))
+        with self.lock:
+            engine = self.engines.get(key)
+            if engine is None:
+                if len(self.engines) >= self.max_engines:
+                    self.engines.pop(next(iter(self.engines)))
+                engine = self.engines[key] = self._create_engine(options)
+        return engine
+    
+    def _create_engine(self, options):
+        mode = options.pop('mode')
+        if mode not in ('optimize', 'compress', 'target'):
+            raise ValueError(f"Unknown mode: {mode}")
+        target_kb = options.pop('target_kb', None)
+        target_percent = options.pop('target_percent', None)
+        if mode == 'target' and not (target_kb or target_percent):
+            raise ValueError("mode=target needs target_kb or target_percent")
+        return BatchEngine(
+            compress=mode == 'compress',
+            workers=1,
+            target_bytes=target_kb * 1024 if mode == 'target' and target_kb else None,
+            target_percent=target_percent if mode == 'target' and not target_kb else None,
+            **options
+        )
+
+
+class CompressionHandler(BaseHTTPRequestHandler):
+    
+    # HTTP/1.1 keeps connections open between requests; idle ones close after the timeout.
+    protocol_version = "HTTP/1.1"
+    timeout = 30
+    # Headers and body go out in separate writes; with Nagle on, the body waits for a delayed ACK.
+    disable_nagle_algorithm = True
+    service = None
+    
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/compress':
+            return self._send_json(404, {'error': 'not found'})
+        
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return self._send_json(411, {'error': 'Content-Length is required'})
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Where the body ends is unknown, so the connection cannot be reused.
+            self.close_connection = True
+            return self._send_json(400, {'error': 'Content-Length must be a non-negative integer'})
+        if length > MAX_BODY_BYTES:
+            # The body is not read, so the connection cannot be reused.
+            self.close_connection = True
+            return self._send_json(413, {'error': f'body larger than {MAX_BODY_BYTES} bytes'})
+        data = self.rfile.read(length)
+        
+        try:
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            filename = query.pop('filename', None)
+            options = {key: REQUEST_OPTIONS[key](value) for key, value in query.items() if key in REQUEST_OPTIONS}
+            output, result = self.service.compress(data, filename, **options)
+        except ServiceBusy:
+            return self._send_json(503, {'error': 'too many requests in flight'}, {'Retry-After': '1'})
+        except ValueError as e:
+            return self._send_json(400, {'error': str(e)})
+        
+        self.service.record(data, output, result)
+        if output is None:
+            return self._send_json(422, {'error': result.error})
+        
+        self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(result.output_path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(output)))
+        self.send_header('X-Output-Filename', os.path.basename(result.output_path))
+        self.send_header('X-Original-Size', str(result.original_size))
+        self.send_header('X-Output-Size', str(len(output)))
+        self.send_header('X-Action', result.action or '')
+        if result.quality is not None:
+            self.send_header('X-Quality', str(result.quality))
+        self.send_header('X-Elapsed-Ms', f"{result.elapsed * 1000:.1f}")
+        self.end_headers()
+        self.wfile.write(output)
+    
+    def do_GET(self):
+        if urlsplit(self.path).path != '/stats':
+            return self._send_json(404, {'error': 'not found'})
+        with self.service.lock:
+            stats = dict(self.service.stats)
+        self._send_json(200, stats)
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class CompressionServer(ThreadingHTTPServer):
+    
+    daemon_threads = True
+    
+    def __init__(self, address, service, max_connections=256):
+        handler = type('Handler', (CompressionHandler,), {'service': service})
+        super().__init__(address, handler)
+        self.service = service
+        self.connections = threading.BoundedSemaphore(max_connections)
+    
+    def verify_request(self, request, client_address):
+        # One thread per keep-alive connection; past the limit new connections are dropped.
+        return self.connections.acquire(blocking=False)
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connections.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve image compression over HTTP on this machine.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None, help="images compressed at once (default: one per CPU)")
+    parser.add_argument("--max-queue", type=int, default=64,
+                        help="requests allowed to wait for a worker before new ones get 503 (default: 64)")
+    parser.add_argument("--max-connections", type=int, default=256, help="open connections allowed (default: 256)")
+    parser.add_argument("--mode", choices=("optimize", "compress", "target"), default="optimize",
+                        help="default mode; requests can override it with ?mode=")
+    parser.add_argument("--quality", type=int, default=85, help="default quality; requests can override it")
+    args = parser.parse_args(argv)
+    
+    service = CompressionService(workers=args.workers, max_queue=args.max_queue,
+                                 mode=args.mode, quality=args.quality)
+    server = CompressionServer((args.host, args.port), service, args.max_connections)
+    print(f"Listening on http://{args.host}:{server.server_address[1]}/compress "
+          f"with {service.workers} workers", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
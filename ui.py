@@ -9,6 +9,9 @@ class UISetup:
         self.progress = None
         self.status_label = None
         self.quality_label = None
+        self.estimate_label = None
+        self.start_button = None
+        self.cancel_button = None
         
         self.setup_ui()
     
@@ -58,14 +61,16 @@ class UISetup:
             quality_frame, 
             text="No Quality Loss (Optimize only)",
             variable=self.app.compression_var, 
-            value=False
+            value=False,
+            command=self.app.schedule_estimate
         ).grid(row=0, column=0, sticky="W", pady=5)
         
         ttk.Radiobutton(
             quality_frame, 
             text="Reduce Size with Quality Adjustment",
             variable=self.app.compression_var, 
-            value=True
+            value=True,
+            command=self.app.schedule_estimate
         ).grid(row=1, column=0, sticky="W", pady=5)
         
         ttk.Label(quality_frame, text="Quality Level:").grid(row=2, column=0, sticky="W", pady=5)
@@ -84,23 +89,35 @@ class UISetup:
         self.quality_label.grid(row=2, column=2, pady=5)
         
         quality_scale.configure(command=self.app.update_quality_label)
+        
+        self.estimate_label = ttk.Label(quality_frame, text="", justify="left")
+        self.estimate_label.grid(row=3, column=0, columnspan=3, sticky="W", pady=(5, 0))
     
     def _setup_progress_and_status(self, parent):
         self.progress = ttk.Progressbar(parent, mode='determinate')
         self.progress.grid(row=4, column=0, columnspan=3, sticky=("W", "E"), pady=10)
         
-        self.status_label = ttk.Label(parent, text="Ready")
+        self.status_label = ttk.Label(parent, text="Ready", justify="center")
         self.status_label.grid(row=5, column=0, columnspan=3, pady=5)
     
     def _setup_buttons(self, parent):
         button_frame = ttk.Frame(parent)
         button_frame.grid(row=6, column=0, columnspan=3, pady=20)
         
-        ttk.Button(
+        self.start_button = ttk.Button(
             button_frame, 
             text="Start Processing",
             command=self.app.start_processing
-        ).pack(side="left", padx=10)
+        )
+        self.start_button.pack(side="left", padx=10)
+        
+        self.cancel_button = ttk.Button(
+            button_frame, 
+            text="Cancel",
+            command=self.app.cancel_processing,
+            state="disabled"
+        )
+        self.cancel_button.pack(side="left", padx=10)
         
         ttk.Button(
             button_frame, 
@@ -1,19 +1,96 @@
-from tkinter import filedialog
+import os
+from fnmatch import fnmatch
 from pathlib import Path
 
 
 class FileOperations:
     
     SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tiff'}
+    # Uncompressed BMP output is never worth writing; the same pixels go to a PNG.
+    OUTPUT_EXTENSIONS = {'.bmp': '.png'}
     
     def select_folder(self, title):
+        from tkinter import filedialog
+        
         return filedialog.askdirectory(title=title)
     
     def get_image_files(self, folder):
-        image_files = []
+        return [Path(path) for path in self.iter_image_files(folder, recursive=False)]
+    
+    def iter_image_files(self, folder, recursive=True, include=None, exclude=None, skip_dirs=()):
+        skip_dirs = {os.path.abspath(path) for path in skip_dirs}
+        stack = [(folder, "")]
         
-        for file_path in Path(folder).iterdir():
-            if file_path.suffix.lower() in self.SUPPORTED_EXTENSIONS and file_path.is_file():
-                image_files.append(file_path)
+        while stack:
+            directory, relative_dir = stack.pop()
+            try:
+                files, subdirs = self.scan_directory(directory, relative_dir, recursive, include, exclude, skip_dirs)
+            except OSError as e:
+                print(f"Cannot scan {directory}: {e}")
+                continue
+            stack.extend(subdirs)
+            yield from files
+    
+    def scan_directory(self, directory, relative_dir="", recursive=True, include=None, exclude=None,
+                       skip_dirs=()):
+        # One level of the walk: the images directly inside the directory, and the
+        # subdirectories to descend into as (path, relative path) pairs.
+        files = []
+        subdirs = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}{entry.name}"
+                
+                # DirEntry caches the type from the directory listing, so these
+                # checks cost no extra stat call on most filesystems.
+                if entry.is_dir(follow_symlinks=False):
+                    if (recursive and not self._matches(relative_path, exclude)
+                            and os.path.abspath(entry.path) not in skip_dirs):
+                        subdirs.append((entry.path, f"{relative_path}/"))
+                    continue
+                
+                if os.path.splitext(entry.name)[1].lower() not in self.SUPPORTED_EXTENSIONS:
+                    continue
+                if include and not self._matches(relative_path, include):
+                    continue
+                if self._matches(relative_path, exclude):
+                    continue
+                if entry.is_file():
+                    files.append(entry.path)
+        return files, subdirs
+    
+    def is_selected_path(self, relative_path, include=None, exclude=None):
+        # Archive members arrive as whole relative paths, so each parent folder is
+        # checked against the exclude patterns as the directory walk would.
+        if os.path.splitext(relative_path)[1].lower() not in self.SUPPORTED_EXTENSIONS:
+            return False
+        if include and not self._matches(relative_path, include):
+            return False
+        parts = relative_path.split('/')
+        return not any(self._matches('/'.join(parts[:i]), exclude) for i in range(1, len(parts) + 1))
+    
+    def iter_jobs(self, input_folder, output_folder, recursive=True, include=None, exclude=None):
+        created_dirs = set()
         
-        return image_files
+        for input_path in self.iter_image_files(
+            input_folder, recursive, include, exclude, skip_dirs=(output_folder,)
+        ):
+            output_path = self.output_path_for(input_path, input_folder, output_folder)
+            output_dir = os.path.dirname(output_path)
+            if output_dir not in created_dirs:
+                os.makedirs(output_dir, exist_ok=True)
+                created_dirs.add(output_dir)
+            yield input_path, output_path
+    
+    def output_path_for(self, input_path, input_folder, output_folder):
+        output_path = os.path.join(output_folder, os.path.relpath(input_path, input_folder))
+        stem, extension = os.path.splitext(output_path)
+        if extension.lower() in self.OUTPUT_EXTENSIONS:
+            output_path = stem + self.OUTPUT_EXTENSIONS[extension.lower()]
+        return output_path
+    
+    def _matches(self, relative_path, patterns):
+        if not patterns:
+            return False
+        name = os.path.basename(relative_path)
+        return any(fnmatch(relative_path, pattern) or fnmatch(name, pattern) for pattern in patterns)
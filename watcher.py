@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+
+from utils import FileOperations
+
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class FolderWatcher:
+    
+    def __init__(self, input_folder, output_folder, recursive=True, include=None, exclude=None,
+                 poll_interval=0.25, settle_time=0.5, full_scan_interval=60.0, file_ops=None):
+        self.input_folder = os.path.abspath(input_folder)
+        self.output_folder = os.path.abspath(output_folder)
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.full_scan_interval = full_scan_interval
+        self.file_ops = file_ops or FileOperations()
+        
+        # path -> [size, mtime_ns, status]
+        self.index = {}
+        # directory -> [mtime_ns, relative path, image paths directly inside it]
+        self.dirs = {self.input_folder: [None, "", set()]}
+        self.pending = set()
+        self.last_full_scan = time.monotonic()
+        self.started = False
+    
+    def run(self, process, stop=None):
+        # process(jobs) returns the results for a list of (input, output) jobs.
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            jobs = self.poll()
+            if not jobs:
+                stop.wait(self.poll_interval)
+                continue
+            for result in process(jobs):
+                self.record(result)
+                yield result
+    
+    def poll(self):
+        now = time.monotonic()
+        if now - self.last_full_scan >= self.full_scan_interval:
+            self._check_indexed_files()
+            self.last_full_scan = now
+        
+        self._check_directories()
+        first_scan, self.started = not self.started, True
+        return self._ready_jobs(first_scan)
+    
+    def record(self, result):
+        entry = self.index.get(result.input_path)
+        # A file that changed again while it was processed stays pending.
+        if entry is not None and result.input_path not in self.pending:
+            entry[2] = DONE if result.success else FAILED
+    
+    def _check_directories(self):
+        # Adding, removing or renaming an entry bumps its directory's mtime, so
+        # only directories that changed are listed again; the rest cost one stat.
+        for directory in list(self.dirs):
+            if directory not in self.dirs:
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                self._forget_directory(directory)
+                continue
+            if mtime != self.dirs[directory][0]:
+                self._rescan(directory, mtime)
+    
+    def _rescan(self, directory, mtime):
+        state = self.dirs[directory]
+        try:
+            files, subdirs = self.file_ops.scan_directory(
+                directory, state[1], self.recursive, self.include, self.exclude,
+                skip_dirs={self.output_folder}
+            )
+        except OSError as e:
+            print(f"Cannot scan {directory}: {e}")
+            return
+        state[0] = mtime
+        
+        files = set(files)
+        for path in state[2] - files:
+            self.index.pop(path, None)
+            self.pending.discard(path)
+        # A file replaced by a rename (how uploaders, rsync and editors write) keeps
+        # its name, so while the directory is listed anyway every known file is checked.
+        for path in state[2] & files:
+            self._check_file(path, self.index[path])
+        for path in files - state[2]:
+            self.index[path] = [None, None, PENDING]
+            self.pending.add(path)
+        state[2] = files
+        
+        for path, relative_dir in subdirs:
+            if path in self.dirs:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            self.dirs[path] = [None, relative_dir, set()]
+            self._rescan(path, mtime)
+    
+    def _forget_directory(self, directory):
+        prefix = directory + os.sep
+        for path in [path for path in self.dirs if path == directory or path.startswith(prefix)]:
+            for file_path in self.dirs.pop(path)[2]:
+                self.index.pop(file_path, None)
+                self.pending.discard(file_path)
+        if directory == self.input_folder:
+            self.dirs[directory] = [None, "", set()]
+    
+    def _check_indexed_files(self):
+        # Rewriting a file in place leaves its directory's mtime alone, so settled
+        # files are re-checked on a much slower schedule.
+        for path, entry in self.index.items():
+            self._check_file(path, entry)
+    
+    def _check_file(self, path, entry):
+        if entry[2] == PENDING:
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        if [stat.st_size, stat.st_mtime_ns] != entry[:2]:
+            entry[2] = PENDING
+            self.pending.add(path)
+    
+    def _ready_jobs(self, first_scan):
+        jobs = []
+        now = time.time_ns()
+        for path in list(self.pending):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = self.index[path]
+            signature = [stat.st_size, stat.st_mtime_ns]
+            changed = entry[0] is not None and signature != entry[:2]
+            entry[:2] = signature
+            
+            # A file still being copied keeps changing size and mtime; it is only
+            # picked up once it has been left alone for the settle time.
+            if changed or now - stat.st_mtime_ns < self.settle_time * 1e9:
+                continue
+            
+            self.pending.discard(path)
+            output_path = self.file_ops.output_path_for(path, self.input_folder, self.output_folder)
+            if first_scan and self._is_current(output_path, stat.st_mtime_ns):
+                entry[2] = DONE
+                continue
+            
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            jobs.append((path, output_path))
+        return jobs
+    
+    def _is_current(self, output_path, source_mtime):
+        # Files that were already reduced before the watcher started are left alone.
+        try:
+            return os.stat(output_path).st_mtime_ns >= source_mtime
+        except OSError:
+            return False